@@ -9,29 +9,24 @@ import socket
 import struct
 import datetime
 import json
+import re
 import array  # Default behaviour is to use array as data type for logging...
 import os
 import gzip
+import collections
+import importlib.util
+import atexit
+import weakref
 # External libraries:
+# These are optional and only imported when they are needed, so that
+# importing this module is quiet and fast
 
-# Numpy is also supported
-try:
-    import numpy as np
-    HaveNumpy = True
-    print("Numpy found... np arrays are supported")
-except ModuleNotFoundError:
-    HaveNumpy = False
-    print("Numpy not found... thats ok, but you can only use python \
-           arrays for data")
-
-try:
-    import psutil
-    HavePsutil = True
-    print("psutil found... I will log CPU and MEM load")
-except ModuleNotFoundError:
-    HavePsutil = False
-    print("psutil not found... please install it to log the CPU load \
-           on this machine (requires python3-devel)")
+# Numpy is also supported (np arrays can only be logged once the caller
+# has imported numpy, so it is looked up in sys.modules when logging)
+HaveNumpy = importlib.util.find_spec("numpy") is not None
+
+# psutil is used to log the CPU and MEM load (/proc is read without it)
+HavePsutil = importlib.util.find_spec("psutil") is not None
 
 
 DataByteOrder = 0
@@ -67,38 +62,69 @@ def GetUnixTimeFromLVTime(timestamp):
 
 
 # Array type parsing functions
+# Data types MIDAS understands, by (signed, size in bytes) for integers
+IntegerTypes = {
+    (True, 1): b"I8\0\0",
+    (True, 2): b"I16\0",
+    (True, 4): b"I32\0",
+    (True, 8): b"I64\0",
+    (False, 1): b"U8\0\0",
+    (False, 2): b"U16\0",
+    (False, 4): b"U32\0",
+    (False, 8): b"U64\0",
+}
+
+# Python array typecode -> data type (integer sizes depend on the platform,
+# eg 'l' is 8 bytes on 64 bit Linux, so they are taken from the itemsize)
+ArrayTypes = {
+    'f': b"FLT\0",
+    'd': b"DBL\0",
+}
+for typecode in "bBhHiIlLqQ":
+    ArrayTypes[typecode] = IntegerTypes[(typecode.islower(),
+                                         array.array(typecode).itemsize)]
+del typecode
+
+# numpy (dtype.kind, dtype.itemsize) -> data type
+NpArrayTypes = {
+    ('f', 4): b"FLT\0",
+    ('f', 8): b"DBL\0",
+    ('b', 1): b"BOOL",
+}
+for [signed, size], datatype in IntegerTypes.items():
+    NpArrayTypes[('i' if signed else 'u', size)] = datatype
+del signed, size, datatype
+
+# Type of the first list item -> (array typecode the list is converted to,
+# data type)
+ListTypes = {
+    float: ('d', b"DBL\0"),
+    int: ('q', b"I64\0"),
+    bool: ('B', b"BOOL"),
+}
+
+
 def GetArrayType(arg):
-    switcher = {
-        'd': b"DBL\0",
-        'f': b"FLT\0",
-        'l': b"I32\0",
-        'L': b"U32\0",
-    }
-    return switcher.get(arg, "Unsupported array type (" + str(arg) +
+    if arg not in ArrayTypes:
+        raise TypeError("Unsupported array type (" + str(arg) +
                         ")... consider using floats?")
+    return ArrayTypes[arg]
 
 
 def GetNpArrayType(arg):
-    switcher = {
-        np.dtype('float64'): b"DBL\0",
-        np.dtype('float32'): b"FLT\0",
-        np.dtype('int32'): b"I32\0",
-        np.dtype('uint32'): b"U32\0",
-    }
-    return switcher.get(arg, "Unsupported numpy array type (" +
-                        str(arg) +
+    datatype = NpArrayTypes.get((arg.kind, arg.itemsize))
+    if datatype is None:
+        raise TypeError("Unsupported numpy array type (" + str(arg) +
                         ")... consider using floats?")
+    return datatype
 
 
-# I only support list of doubles!
+# Returns (array typecode, data type) for a list of this type
 def GetListType(arg):
-    switcher = {
-        type(float()): b"DBL\0",
-        # b"I64\0": int,
-    }
-    return switcher.get(arg, "Unsupported list type (" +
-                        str(arg) +
-                        ")... consider using floats?")
+    if arg not in ListTypes:
+        raise TypeError("Unsupported list type (" + str(arg) +
+                        ")... use floats, ints or bools")
+    return ListTypes[arg]
 
 
 def CleanString(arg, length):
@@ -107,12 +133,1010 @@ def CleanString(arg, length):
     return arg
 
 
+# BankArrayID of a packed event (None for a single GEB1 bank)
+def GetBankArrayID(event):
+    if event[0:4] != b"GEA1":
+        return None
+    return struct.unpack_from('I', event, 4)[0]
+
+
+# Split a packed event (GEA1 super bank or single GEB1 bank) into several
+# GEB1 banks, none of which is larger than max_size
+def SplitBundle(bundle, max_size):
+    if bundle[0:4] != b"GEA1":
+        return SplitBank(bundle, max_size)
+    [BankArrayID, length, number_of_banks] = struct.unpack_from('III',
+                                                                 bundle,
+                                                                 4)
+    events = []
+    offset = 16
+    for i in range(number_of_banks):
+        [block_size, num_blocks] = struct.unpack_from('ii', bundle,
+                                                      offset + 80)
+        bank_end = offset + DataBank.LVBANKHEADERSIZE + \
+            block_size * num_blocks
+        events += SplitBank(bundle[offset:bank_end], max_size)
+        offset = bank_end
+    return events
+
+
+# Split a single GEB1 bank into several banks, each with a subset of the
+# LVDATA blocks (the header is copied and the block count updated)
+def SplitBank(bank, max_size):
+    if len(bank) <= max_size:
+        return [bank]
+    header_size = DataBank.LVBANKHEADERSIZE
+    [block_size, num_blocks] = struct.unpack_from('ii', bank, 80)
+    blocks_per_bank = (max_size - header_size) // block_size
+    if blocks_per_bank < 1:
+        print("Single LVDATA block (" + str(block_size) +
+              " bytes) is larger than MaxEventSize... dropping it")
+        return []
+    banks = []
+    for first in range(0, num_blocks, blocks_per_bank):
+        n = min(blocks_per_bank, num_blocks - first)
+        start = header_size + first * block_size
+        banks.append(bank[0:80] +
+                     struct.pack('ii', block_size, n) +
+                     bank[start:start + n * block_size])
+    return banks
+
+
+# Load shedding policies: what a DataPacker does when there is more data
+# waiting than MIDAS accepts in a single event
+SHED_SPLIT = "split"  # Send several events in the same flush
+SHED_DEFER = "defer"  # Leave the overflow in the banks for the next flush
+SHED_DROP = "drop"    # Drop the backlog of the lowest priority banks
+SHED_RAISE = "raise"  # Keep the backlog, raise DataPackerOverload in AddData
+
+
+# Raised (from AddData) when the SHED_RAISE policy is in use and the
+# DataPacker could not send everything it was given. The sample given to
+# the AddData call that raises is queued all the same (do not add it again)
+class DataPackerOverload(Exception):
+    def __init__(self, length, limit, reason):
+        self.length = length
+        self.limit = limit
+        self.reason = reason
+        Exception.__init__(self,
+                           reason + " (" + str(length) + " bytes > " +
+                           str(limit) + " bytes MaxEventSize)")
+
+
+# Holds the load shedding policy of a DataPacker and counts shed events
+class LoadShedder:
+    # Code of each kind of shed event, as logged in the LOADSHED bank
+    EventCodes = {
+        SHED_SPLIT: 1,
+        SHED_DEFER: 2,
+        SHED_DROP: 3,
+        SHED_RAISE: 4,
+        "reject": 5,  # MIDAS replied with an ERROR
+    }
+
+    def __init__(self, policy=SHED_DEFER, max_events_per_flush=10):
+        assert policy in (SHED_SPLIT, SHED_DEFER, SHED_DROP, SHED_RAISE), \
+            "Unknown load shedding policy (" + str(policy) + ")"
+        assert max_events_per_flush >= 1
+        self.Policy = policy
+        self.MaxEventsPerFlush = max_events_per_flush
+        self.ShedCount = dict.fromkeys(self.EventCodes, 0)
+        self.ShedBytes = 0
+        self.DroppedSamples = 0
+        # Exception waiting to be raised in the next AddData call
+        self.Pending = None
+
+    def Record(self, kind, n_bytes, n_dropped):
+        self.ShedCount[kind] += 1
+        self.ShedBytes += n_bytes
+        self.DroppedSamples += n_dropped
+        print("Load shedding (" + kind + "): " + str(n_bytes) +
+              " bytes, " + str(n_dropped) + " samples dropped")
+        return array.array('d', [self.EventCodes[kind],
+                                 n_bytes,
+                                 n_dropped,
+                                 self.ShedCount[kind]])
+
+
+# Splits the stream of replies MIDAS sends back on one connection into
+# separate replies. The end of each JSON object is found by tracking the
+# brace depth outside of strings, so braces inside strings are fine and
+# each byte is only scanned once. A reply that is not JSON (eg "ERROR...")
+# is returned as bytes, it ends at a newline, a "{" or the end of the
+# connection. With single_reply (one reply per connection, which the client
+# closes) it also ends at the end of the chunk it arrived in
+class ReplyReader:
+    # Characters that matter outside and inside of a JSON string
+    OutsideString = re.compile(rb'[{}"]')
+    InsideString = re.compile(rb'["\\]')
+    EndOfText = re.compile(rb'[{\n]')
+    Whitespace = b" \t\r\n"
+
+    def __init__(self, sock, chunk_size=4096, single_reply=False):
+        self.socket = sock
+        self.ChunkSize = chunk_size
+        self.SingleReply = single_reply
+        self.Buffer = bytearray()
+        self.Decoder = json.JSONDecoder()
+        # Complete replies not returned by Read yet
+        self.Replies = collections.deque()
+        # Scan state of the reply at the start of Buffer
+        self.ScanPos = 0
+        self.Depth = 0
+        self.InString = False
+
+    # Wait for the next reply. Raises ConnectionResetError if MIDAS closes
+    # the connection first (socket.timeout if it takes too long)
+    def Read(self):
+        while len(self.Replies) == 0:
+            chunk = self.socket.recv(self.ChunkSize)
+            if not chunk:
+                if self.Depth == 0 and len(self.Buffer):
+                    # Connection closed at the end of a reply that is
+                    # not JSON
+                    self.Replies.append(bytes(self.Buffer))
+                    self.Buffer.clear()
+                    break
+                raise ConnectionResetError("Connection closed by MIDAS " +
+                                           "before a complete reply")
+            self.Feed(chunk)
+            if self.SingleReply and len(self.Replies) == 0 and \
+                    self.Depth == 0 and len(self.Buffer):
+                # Text that is not JSON, MIDAS is not sending anything else
+                self.Replies.append(bytes(self.Buffer))
+                self.Buffer.clear()
+        return self.Replies.popleft()
+
+    def Feed(self, chunk):
+        self.Buffer += chunk
+        while self.__ScanReply():
+            pass
+
+    # Move one reply from Buffer to Replies, returns False if the rest of
+    # Buffer is not a complete reply yet
+    def __ScanReply(self):
+        if self.Depth == 0:
+            # Between replies... skip whitespace
+            start = 0
+            while start < len(self.Buffer) and \
+                    self.Buffer[start] in self.Whitespace:
+                start += 1
+            del self.Buffer[:start]
+            if len(self.Buffer) == 0:
+                return False
+            if self.Buffer[0] != ord("{"):
+                # Not JSON, return everything up to the next reply
+                match = self.EndOfText.search(self.Buffer)
+                if match is None:
+                    return False
+                end = match.start()
+                self.Replies.append(bytes(self.Buffer[:end]))
+                del self.Buffer[:end]
+                return True
+            self.Depth = 1
+            self.ScanPos = 1
+        while self.Depth:
+            if self.InString:
+                match = self.InsideString.search(self.Buffer, self.ScanPos)
+                if match is None:
+                    self.ScanPos = len(self.Buffer)
+                    return False
+                if match.group() == b"\\":
+                    if match.end() == len(self.Buffer):
+                        # Need the escaped character before going on
+                        self.ScanPos = match.start()
+                        return False
+                    self.ScanPos = match.end() + 1
+                    continue
+                self.InString = False
+            else:
+                match = self.OutsideString.search(self.Buffer, self.ScanPos)
+                if match is None:
+                    self.ScanPos = len(self.Buffer)
+                    return False
+                if match.group() == b'"':
+                    self.InString = True
+                elif match.group() == b"{":
+                    self.Depth += 1
+                else:
+                    self.Depth -= 1
+            self.ScanPos = match.end()
+        [reply, end] = self.Decoder.raw_decode(
+            self.Buffer[:self.ScanPos].decode("utf-8"))
+        self.Replies.append(reply)
+        del self.Buffer[:self.ScanPos]
+        self.ScanPos = 0
+        return True
+
+
+# Send modes of a DataPacker with more than one endpoint
+SEND_FANOUT = "fanout"      # Every event is sent to every endpoint
+SEND_FAILOVER = "failover"  # Every event is sent to the first healthy one
+
+
+# Connection state of one MIDAS frontend a DataPacker sends to. Each
+# endpoint has its own sender thread, timeout and backlog of packed events.
+# With a window larger than 1, events are pipelined: up to window events
+# are sent on one connection before their replies come back
+class MidasEndpoint:
+    def __init__(self, midas_server, port=12345, timeout=10.0,
+                 max_backlog=100, max_data_rate=0, window=1):
+        self.experiment = midas_server
+        self.initial_port = port
+        self.port = port
+        self.address = midas_server
+        self.Timeout = timeout
+        self.RequestedEventSize = max_data_rate
+        self.MaxEventSize = -1
+        self.FrontendStatus = ""
+        self.RunNumber = -99
+        self.RunStatus = str()
+        self.Connected = False
+        self.Healthy = False
+        self.DroppedEvents = 0
+        self.Thread = None
+        # Packed events waiting to be sent (oldest dropped when full)
+        self.Backlog = collections.deque()
+        self.MaxBacklog = max_backlog
+        self.BacklogReady = threading.Condition()
+        # Pipelined sending: events sent but not acknowledged, by
+        # BankArrayID (in the order they were sent)
+        assert window >= 1
+        self.Window = window
+        self.InFlight = collections.OrderedDict()
+        self.socket = None
+        self.Pipe = None
+
+    def Name(self):
+        return str(self.experiment) + ":" + str(self.initial_port)
+
+    # Add a packed event to the end of the backlog. If it is full, wait
+    # (until deadline, a time.time()) for space before dropping the oldest
+    def Queue(self, event, deadline=None):
+        self.BacklogReady.acquire()
+        while deadline is not None and \
+                len(self.Backlog) >= self.MaxBacklog and \
+                time.time() < deadline:
+            self.BacklogReady.wait(min(deadline - time.time(), 0.1))
+        if len(self.Backlog) >= self.MaxBacklog:
+            self.Backlog.popleft()
+            self.DroppedEvents += 1
+            print("Backlog of " + self.Name() + " is full... " +
+                  "oldest event dropped")
+        self.Backlog.append(event)
+        self.BacklogReady.notify()
+        self.BacklogReady.release()
+
+    # Oldest event in the backlog (it stays there until Sent is called),
+    # None if nothing arrives within timeout seconds
+    def Next(self, timeout):
+        self.BacklogReady.acquire()
+        if len(self.Backlog) == 0:
+            self.BacklogReady.wait(timeout)
+        event = None
+        if len(self.Backlog):
+            event = self.Backlog[0]
+        self.BacklogReady.release()
+        return event
+
+    # Remove an event returned by Next from the backlog
+    def Sent(self, event):
+        self.BacklogReady.acquire()
+        if len(self.Backlog) and self.Backlog[0] is event:
+            self.Backlog.popleft()
+            self.BacklogReady.notify_all()
+        self.BacklogReady.release()
+
+    # Empty the backlog, returning everything that was in it (events in
+    # flight first)
+    def TakeBacklog(self):
+        self.BacklogReady.acquire()
+        events = list(self.InFlight.values()) + list(self.Backlog)
+        self.InFlight.clear()
+        self.Backlog.clear()
+        self.BacklogReady.release()
+        return events
+
+    # Events not acknowledged by MIDAS yet
+    def Unacknowledged(self):
+        return len(self.Backlog) + len(self.InFlight)
+
+    # Pipelined sending: move the oldest event in the backlog to InFlight,
+    # None if nothing arrives within timeout seconds
+    def Launch(self, timeout):
+        self.BacklogReady.acquire()
+        if len(self.Backlog) == 0 and timeout > 0:
+            self.BacklogReady.wait(timeout)
+        event = None
+        if len(self.Backlog):
+            event = self.Backlog.popleft()
+            self.InFlight[GetBankArrayID(event)] = event
+            self.BacklogReady.notify_all()
+        self.BacklogReady.release()
+        return event
+
+    # Remove an event from InFlight when its reply arrives. Replies without
+    # a BankArrayID we know (eg a reply to a retransmit) acknowledge the
+    # oldest event, so the window never stalls
+    def Acknowledge(self, BankArrayID=None):
+        try:
+            BankArrayID = int(BankArrayID)
+        except (TypeError, ValueError):
+            BankArrayID = None
+        self.BacklogReady.acquire()
+        event = self.InFlight.pop(BankArrayID, None)
+        if event is None and len(self.InFlight):
+            event = self.InFlight.popitem(last=False)[1]
+        self.BacklogReady.release()
+        return event
+
+    # Put the events in flight back at the front of the backlog, so they
+    # are sent again (in order) once there is a new connection
+    def Requeue(self):
+        self.BacklogReady.acquire()
+        self.Backlog.extendleft(reversed(list(self.InFlight.values())))
+        self.InFlight.clear()
+        self.BacklogReady.release()
+
+
+# Metrics a TelemetrySampler can log (the bank each one goes to):
+#   cpu   - Load of each CPU core in % (CPUMEM)
+#   mem   - Memory used in % (last entry of CPUMEM)
+#   net   - Bytes per second sent and received by the host (NETIO)
+#   disk  - Bytes per second read and written by the host (DISKIO)
+#   rss   - Resident memory of this process in bytes (RSS)
+#   queue - Samples and bytes in the banks, events waiting to be sent
+#           (QUEUE, logged by each DataPacker)
+TELEMETRY_METRICS = ("cpu", "mem", "net", "disk", "rss", "queue")
+
+
+# Samples host and process load for every DataPacker in the process. It has
+# no thread of its own, the flush threads of the packers poll it and each
+# of them logs every sample. With per_host set (opt-in), only one process
+# on the host (the one holding LockFile) logs the host wide metrics
+class TelemetrySampler:
+    LockFile = "/tmp/MIDAS_GEM_telemetry.lock"
+
+    def __init__(self, interval=60., metrics=("cpu", "mem"), per_host=False):
+        self.Lock = threading.Lock()
+        # The latest sample (given to every DataPacker once) and its number
+        self.Logs = []
+        self.SampleNumber = 0
+        self.psutil = None
+        if HavePsutil:
+            import psutil
+            self.psutil = psutil
+        self.HostLock = None
+        self.Configure(interval, metrics, per_host)
+        # Rates are measured from one sample to the next, so read the
+        # counters once now
+        self.LastTime = time.monotonic()
+        self.Counters = self.__ReadCounters()
+
+    def Configure(self, interval=60., metrics=("cpu", "mem"), per_host=False):
+        for metric in metrics:
+            assert metric in TELEMETRY_METRICS, \
+                "Unknown telemetry metric (" + str(metric) + ")"
+        self.Interval = interval
+        self.Metrics = tuple(metrics)
+        self.PerHost = per_host
+
+    # Returns (sample number, list of (varname, array) to log). The host is
+    # sampled once per interval, and each caller gets every sample once:
+    # last is the sample number the caller got last time
+    def Poll(self, last=0):
+        now = time.monotonic()
+        if now - self.LastTime >= self.Interval:
+            self.Lock.acquire()
+            if now - self.LastTime >= self.Interval:
+                self.Logs = self.__Sample(now)
+                self.SampleNumber += 1
+            self.Lock.release()
+        [number, logs] = [self.SampleNumber, self.Logs]
+        if number == last:
+            return [last, []]
+        return [number, list(logs)]
+
+    def __Sample(self, now):
+        counters = self.__ReadCounters()
+        elapsed = now - self.LastTime
+        previous = self.Counters
+        self.LastTime = now
+        self.Counters = counters
+        logs = []
+        if not self.PerHost or self.__IsHostSampler():
+            CPUMEM = array.array('d')
+            if "cpu" in counters and "cpu" in previous:
+                CPUMEM.extend(self.__CPUPercent(previous["cpu"],
+                                                counters["cpu"]))
+            if "mem" in self.Metrics:
+                CPUMEM.append(self.__MemPercent())
+            if len(CPUMEM):
+                logs.append(("CPUMEM", CPUMEM))
+            for metric, varname in (("net", "NETIO"), ("disk", "DISKIO")):
+                if metric in counters and metric in previous:
+                    logs.append((varname, array.array('d', [
+                        (counters[metric][0] - previous[metric][0]) / elapsed,
+                        (counters[metric][1] - previous[metric][1]) / elapsed
+                    ])))
+        if "rss" in self.Metrics:
+            logs.append(("RSS", array.array('d', [self.__RSS()])))
+        return logs
+
+    # Cumulative counters of the metrics that are logged as rates
+    def __ReadCounters(self):
+        counters = {}
+        try:
+            if "cpu" in self.Metrics:
+                if self.psutil:
+                    # psutil measures from its own previous call
+                    counters["cpu"] = self.psutil.cpu_percent(percpu=True)
+                else:
+                    counters["cpu"] = ReadProcCPUTimes()
+            if "net" in self.Metrics:
+                if self.psutil:
+                    net = self.psutil.net_io_counters()
+                    counters["net"] = (net.bytes_sent, net.bytes_recv)
+                else:
+                    counters["net"] = ReadProcNetIO()
+            if "disk" in self.Metrics:
+                if self.psutil:
+                    disk = self.psutil.disk_io_counters()
+                    if disk is not None:
+                        counters["disk"] = (disk.read_bytes,
+                                            disk.write_bytes)
+                else:
+                    counters["disk"] = ReadProcDiskIO()
+        except OSError:
+            print("Telemetry not available on this machine: " +
+                  str(sys.exc_info()[1]))
+        return counters
+
+    def __CPUPercent(self, previous, current):
+        if self.psutil:
+            return current
+        percent = []
+        for [busy0, total0], [busy1, total1] in zip(previous, current):
+            if total1 > total0:
+                percent.append(100. * (busy1 - busy0) / (total1 - total0))
+            else:
+                percent.append(0.)
+        return percent
+
+    def __MemPercent(self):
+        if self.psutil:
+            return self.psutil.virtual_memory().percent
+        return ReadProcMemPercent()
+
+    def __RSS(self):
+        if self.psutil:
+            return self.psutil.Process().memory_info().rss
+        return ReadProcRSS()
+
+    # Take (or check we still hold) the host wide telemetry lock
+    def __IsHostSampler(self):
+        if self.HostLock is not None:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            # No way to agree on one process per host, all of them log
+            return True
+        try:
+            lock = open(self.LockFile, "a")
+        except OSError:
+            return True
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return False
+        # Held until this process exits
+        self.HostLock = lock
+        return True
+
+
+# /proc readers, used when psutil is not installed (Linux only)
+# [busy, total] jiffies of each CPU core
+def ReadProcCPUTimes():
+    cores = []
+    with open("/proc/stat") as stat:
+        for line in stat:
+            fields = line.split()
+            if fields[0].startswith("cpu") and fields[0] != "cpu":
+                times = [int(field) for field in fields[1:]]
+                total = sum(times[0:8])
+                # idle + iowait
+                cores.append([total - times[3] - times[4], total])
+    return cores
+
+
+def ReadProcMemPercent():
+    meminfo = {}
+    with open("/proc/meminfo") as info:
+        for line in info:
+            fields = line.split()
+            meminfo[fields[0]] = int(fields[1])
+    total = meminfo["MemTotal:"]
+    return 100. * (total - meminfo["MemAvailable:"]) / total
+
+
+# (bytes sent, bytes received) summed over all network interfaces
+def ReadProcNetIO():
+    sent = 0
+    received = 0
+    with open("/proc/net/dev") as dev:
+        for line in dev:
+            if ":" not in line:
+                continue
+            fields = line.split(":", 1)[1].split()
+            received += int(fields[0])
+            sent += int(fields[8])
+    return (sent, received)
+
+
+# (bytes read, bytes written) summed over all disks (not partitions)
+def ReadProcDiskIO():
+    read = 0
+    written = 0
+    with open("/proc/diskstats") as stats:
+        for line in stats:
+            fields = line.split()
+            if os.path.exists("/sys/block/" + fields[2]):
+                read += int(fields[5]) * 512
+                written += int(fields[9]) * 512
+    return (read, written)
+
+
+def ReadProcRSS():
+    with open("/proc/self/statm") as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+# One TelemetrySampler is shared by every DataPacker in the process
+Telemetry = None
+TelemetryLock = threading.Lock()
+
+
+def GetTelemetrySampler():
+    global Telemetry
+    TelemetryLock.acquire()
+    if Telemetry is None:
+        Telemetry = TelemetrySampler()
+    TelemetryLock.release()
+    return Telemetry
+
+
+# Change what is logged (and how often) by every DataPacker in the process,
+# use metrics=() to turn telemetry off
+def ConfigureTelemetry(interval=60., metrics=("cpu", "mem"), per_host=False):
+    GetTelemetrySampler().Configure(interval, metrics, per_host)
+
+
+# COMMAND and TALK messages waiting to be sent to MIDAS. Each message is
+# packed into its own bank straight away (no DataBank is kept for it),
+# identical messages waiting to be sent are merged, and all of them go out
+# together at the front of the next event. The periodic requests (eg
+# GET_RUNNO) are queued every PollInterval seconds, whatever the data rate
+class ControlChannel:
+    def __init__(self, poll_interval=1.):
+        self.Lock = threading.Lock()
+        # Packed bank of each pending message, by message
+        self.Pending = collections.OrderedDict()
+        self.Merged = 0
+        self.PeriodicTasks = []
+        self.PollInterval = poll_interval
+        self.LastPoll = 0.
+
+    # Queue a message (data must already be bytes)
+    def Add(self, TYPE, category, varname, description, history_settings,
+            history_rate, timestamp, data):
+        key = (category, varname, description, bytes(data))
+        self.Lock.acquire()
+        if key in self.Pending:
+            self.Merged += 1
+        else:
+            self.Pending[key] = b''.join([
+                DataBank.LVBANKPREFIX.pack(b"GEB1",
+                                           TYPE,
+                                           category,
+                                           varname,
+                                           description,
+                                           history_settings,
+                                           history_rate,
+                                           DataByteOrder,
+                                           DataByteOrder),
+                DataBank.LVBANKBLOCKS.pack(16 + len(data), 1),
+                timestamp,
+                data])
+        self.Lock.release()
+
+    def AddPeriodicTask(self, task):
+        if task not in self.PeriodicTasks:
+            self.PeriodicTasks.append(task)
+            # Send the first request with the next event
+            self.LastPoll = 0.
+
+    # Time the periodic requests are next due
+    def NextPoll(self):
+        if len(self.PeriodicTasks) == 0:
+            return float("inf")
+        return self.LastPoll + self.PollInterval
+
+    # Queue the periodic requests, if they are due
+    def Poll(self, now):
+        if now < self.NextPoll():
+            return
+        self.LastPoll = now
+        for task in self.PeriodicTasks:
+            self.Add(b"STR\0",
+                     b"THISHOST",
+                     b"COMMAND",
+                     bytes(task, 'utf-8')[0:32],
+                     0,
+                     0,
+                     GetLVTimeNow(),
+                     b"\0\0")
+
+    def NumberPending(self):
+        return len(self.Pending)
+
+    # Take all the pending messages: (packed banks, number of banks)
+    def Take(self):
+        self.Lock.acquire()
+        banks = list(self.Pending.values())
+        self.Pending.clear()
+        self.Lock.release()
+        return (b''.join(banks), len(banks))
+
+
+# Eviction policies: what happens to a bank that is over its cap (or
+# would take the process over the memory budget) when data is added
+EVICT_DROP_OLDEST = "drop-oldest"  # Forget the oldest samples in the bank
+EVICT_DROP_NEWEST = "drop-newest"  # Forget the sample being added
+EVICT_DECIMATE = "decimate"        # Keep every k-th new sample (making
+                                   # space for it like drop-oldest)
+EVICT_BLOCK = "block"              # Make the producer wait for space
+
+
+# Accounts for the bytes held in DataBank.DataList by every DataPacker in
+# the process, and evicts samples to keep them within max_bytes (all banks)
+# and bank_cap (each bank, unless set with DataPacker.SetBankCap). None
+# means no limit
+class MemoryBudget:
+    def __init__(self, max_bytes=None, policy=EVICT_DROP_OLDEST,
+                 bank_cap=None, decimate_factor=2, block_timeout=10.):
+        self.Space = threading.Condition()
+        # Bytes held by all banks (only counted while max_bytes is set)
+        self.Held = 0
+        # Producers waiting for space (EVICT_BLOCK)
+        self.Waiting = 0
+        # Every bank accounted here, so the global limit can evict from any
+        self.Banks = weakref.WeakSet()
+        self.Configure(max_bytes, policy, bank_cap, decimate_factor,
+                       block_timeout)
+
+    def Configure(self, max_bytes=None, policy=EVICT_DROP_OLDEST,
+                  bank_cap=None, decimate_factor=2, block_timeout=10.):
+        assert policy in (EVICT_DROP_OLDEST, EVICT_DROP_NEWEST,
+                          EVICT_DECIMATE, EVICT_BLOCK), \
+            "Unknown eviction policy (" + str(policy) + ")"
+        assert decimate_factor >= 2
+        self.Space.acquire()
+        self.MaxBytes = max_bytes
+        self.Policy = policy
+        self.BankCap = bank_cap
+        self.DecimateFactor = decimate_factor
+        self.BlockTimeout = block_timeout
+        # Nothing is counted without a limit, so count what is there now
+        self.__Count()
+        self.Space.release()
+
+    # Count the bytes held by the banks that are still alive (banks that
+    # were garbage collected never release what they held)
+    def __Count(self):
+        self.Held = 0
+        if self.MaxBytes is not None:
+            for bank in list(self.Banks):
+                self.Held += bank.BytesHeld()
+
+    def Track(self, bank):
+        self.Space.acquire()
+        self.Banks.add(bank)
+        self.Space.release()
+
+    # Bank holding the most bytes (evicted from for the global limit)
+    def __Largest(self):
+        largest = None
+        held = 0
+        for bank in list(self.Banks):
+            if bank.BytesHeld() > held:
+                [largest, held] = [bank, bank.BytesHeld()]
+        return largest
+
+    # Make space for size bytes in bank, returns False if the new sample
+    # has to be dropped instead. Going over the bank cap evicts from bank
+    # (with its own policy), going over max_bytes evicts from the largest
+    # bank
+    def Admit(self, bank, size):
+        cap = self.BankCap
+        if bank.MaxBytes is not None:
+            cap = bank.MaxBytes
+        if cap is None and self.MaxBytes is None:
+            return True
+        deadline = None
+        counted = False
+        decimated = False
+        self.Space.acquire()
+        try:
+            while True:
+                excess = 0
+                if cap is not None:
+                    excess = bank.BytesHeld() + size - cap
+                if excess > 0:
+                    [victim, policy] = [bank, bank.EvictionPolicy]
+                    policy = policy or self.Policy
+                elif self.MaxBytes is not None and \
+                        self.Held + size > self.MaxBytes and not counted:
+                    # Make sure this is not left over from dead banks
+                    self.__Count()
+                    counted = True
+                    continue
+                elif self.MaxBytes is not None and \
+                        self.Held + size > self.MaxBytes:
+                    excess = self.Held + size - self.MaxBytes
+                    [victim, policy] = [self.__Largest(), self.Policy]
+                else:
+                    break
+                # The DataPacker threads free the space, so never block them
+                if policy == EVICT_BLOCK and \
+                        not threading.current_thread().name.startswith(
+                            "MIDAS_GEM"):
+                    if deadline is None:
+                        deadline = time.time() + self.BlockTimeout
+                    if time.time() < deadline:
+                        self.Waiting += 1
+                        self.Space.wait(min(deadline - time.time(), 0.1))
+                        self.Waiting -= 1
+                        continue
+                if policy == EVICT_DECIMATE and not decimated:
+                    # Keep one in k of the samples added over the limit,
+                    # the stride carries on from one sample to the next
+                    decimated = True
+                    bank.Decimated += 1
+                    if bank.Decimated % self.DecimateFactor:
+                        bank.Evicted += 1
+                        return False
+                freed = 0
+                if victim is not None and \
+                        policy in (EVICT_DROP_OLDEST, EVICT_DECIMATE):
+                    freed = victim.Evict(excess)
+                if freed == 0:
+                    # Nothing (left) to evict, drop the new sample
+                    bank.Evicted += 1
+                    return False
+                if self.MaxBytes is not None:
+                    self.Held -= freed
+            if self.MaxBytes is not None:
+                self.Held += size
+            return True
+        finally:
+            self.Space.release()
+
+    # Bytes no longer held (flushed or dropped)
+    def Release(self, size):
+        if self.MaxBytes is None and self.Waiting == 0:
+            return
+        self.Space.acquire()
+        if self.MaxBytes is not None:
+            self.Held = max(self.Held - size, 0)
+        self.Space.notify_all()
+        self.Space.release()
+
+
+# One MemoryBudget is shared by every DataPacker in the process
+Memory = None
+MemoryLock = threading.Lock()
+
+
+def GetMemoryBudget():
+    global Memory
+    MemoryLock.acquire()
+    if Memory is None:
+        Memory = MemoryBudget()
+    MemoryLock.release()
+    return Memory
+
+
+# Limit the memory all DataPackers in the process use to hold data
+def ConfigureMemoryBudget(max_bytes=None, policy=EVICT_DROP_OLDEST,
+                          bank_cap=None, decimate_factor=2,
+                          block_timeout=10.):
+    GetMemoryBudget().Configure(max_bytes, policy, bank_cap,
+                                decimate_factor, block_timeout)
+
+
+# Stages of a flush cycle timed by a LatencyTracer:
+#   queue   - Mean time the samples waited in their banks before packing
+#   pack    - Flattening the banks into an event (__Flush)
+#   backlog - Event waiting for the endpoint thread to send it
+#   send    - Connecting and sending the event
+#   reply   - Waiting for MIDAS to acknowledge the event
+TRACE_STAGES = ("queue", "pack", "backlog", "send", "reply")
+
+
+# Nearest rank percentiles of values, 0. if there are none
+def Percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    if len(values) == 0:
+        return [0. for point in points]
+    return [values[min(len(values) - 1, int(len(values) * point / 100.))]
+            for point in points]
+
+
+# Opt-in tracing of how long samples take from AddData to MIDAS, see
+# DataPacker.EnableTracing(). Banks record the time each sample is added,
+# events carry the times of the samples packed into them until MIDAS
+# acknowledges them
+class LatencyTracer:
+    def __init__(self, max_samples=10000, profile=False,
+                 trace_memory=False):
+        self.Lock = threading.Lock()
+        # Age of samples (seconds) when packed and when acknowledged
+        self.PackAges = collections.deque(maxlen=max_samples)
+        self.AckAges = collections.deque(maxlen=max_samples)
+        self.Stages = {}
+        for stage in TRACE_STAGES:
+            self.Stages[stage] = collections.deque(maxlen=max_samples)
+        # Called with the stage durations of every acknowledged flush cycle
+        self.Hooks = []
+        # Enqueue times of the samples packed since the last event
+        self.Cycle = []
+        # Events on their way to MIDAS: id(event) -> [event, timing]
+        self.Events = collections.OrderedDict()
+        self.MaxEvents = 1000
+        # cProfile and tracemalloc are only imported when asked for
+        self.Profiler = None
+        self.ProfileLock = threading.Lock()
+        if profile:
+            import cProfile
+            self.Profiler = cProfile.Profile()
+        # tracemalloc is only stopped by Close() if it was started here
+        self.TraceMemory = trace_memory
+        self.StartedTracemalloc = False
+        if trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.StartedTracemalloc = True
+
+    def Close(self):
+        if self.StartedTracemalloc:
+            import tracemalloc
+            tracemalloc.stop()
+            self.StartedTracemalloc = False
+        self.TraceMemory = False
+
+    # Samples added at times (time.monotonic()) have been packed
+    def Packed(self, times):
+        now = time.monotonic()
+        self.Lock.acquire()
+        self.PackAges.extend([now - t for t in times])
+        self.Cycle.extend(times)
+        self.Lock.release()
+
+    # The samples packed since the last call went into event
+    def Event(self, event, pack_start, pack_stop):
+        self.Lock.acquire()
+        if len(self.Cycle):
+            self.Events[id(event)] = [event, {"enqueued": self.Cycle,
+                                              "pack_start": pack_start,
+                                              "packed": pack_stop}]
+            self.Cycle = []
+            # Events dropped on the way never get acknowledged
+            while len(self.Events) > self.MaxEvents:
+                self.Events.popitem(last=False)
+        self.Lock.release()
+
+    # event was split up, it is acknowledged with the last part
+    def Split(self, event, last_part):
+        self.Lock.acquire()
+        traced = self.Events.pop(id(event), None)
+        if traced is not None:
+            self.Events[id(last_part)] = [last_part, traced[1]]
+        self.Lock.release()
+
+    def Forget(self, event):
+        self.Lock.acquire()
+        self.Events.pop(id(event), None)
+        self.Lock.release()
+
+    # event was sent between send_start and send_stop
+    def Sent(self, event, send_start, send_stop):
+        self.Lock.acquire()
+        traced = self.Events.get(id(event))
+        if traced is not None and traced[0] is event:
+            traced[1]["send_start"] = send_start
+            traced[1]["send_stop"] = send_stop
+        self.Lock.release()
+
+    # MIDAS replied to event (the first endpoint to reply counts)
+    def Acknowledged(self, event):
+        now = time.monotonic()
+        self.Lock.acquire()
+        traced = self.Events.pop(id(event), None)
+        if traced is None or traced[0] is not event:
+            self.Lock.release()
+            return
+        timing = traced[1]
+        enqueued = timing["enqueued"]
+        send_start = timing.get("send_start", timing["packed"])
+        send_stop = timing.get("send_stop", send_start)
+        cycle = {
+            "samples": len(enqueued),
+            "queue": timing["pack_start"] - sum(enqueued) / len(enqueued),
+            "pack": timing["packed"] - timing["pack_start"],
+            "backlog": send_start - timing["packed"],
+            "send": send_stop - send_start,
+            "reply": now - send_stop,
+        }
+        self.AckAges.extend([now - t for t in enqueued])
+        for stage in TRACE_STAGES:
+            self.Stages[stage].append(cycle[stage])
+        hooks = list(self.Hooks)
+        self.Lock.release()
+        for hook in hooks:
+            hook(cycle)
+
+    # Call func, under cProfile if profiling is on. Only one thread is
+    # profiled at a time (the others run unprofiled meanwhile)
+    def Profiled(self, func, *args):
+        if self.Profiler is None or \
+                not self.ProfileLock.acquire(blocking=False):
+            return func(*args)
+        self.Profiler.enable()
+        try:
+            return func(*args)
+        finally:
+            self.Profiler.disable()
+            self.ProfileLock.release()
+
+    # Percentiles of the sample ages and stage durations (seconds)
+    def Report(self, points=(50, 90, 99)):
+        self.Lock.acquire()
+        report = {"pack_age": Percentiles(self.PackAges, points),
+                  "ack_age": Percentiles(self.AckAges, points)}
+        for stage in TRACE_STAGES:
+            report[stage] = Percentiles(self.Stages[stage], points)
+        self.Lock.release()
+        return report
+
+    # Median and 99th percentile age at packing and acknowledgement (for
+    # the LATENCY bank)
+    def Record(self):
+        report = self.Report((50, 99))
+        return array.array('d', report["pack_age"] + report["ack_age"])
+
+    def PrintProfile(self, limit=20):
+        if self.Profiler is not None:
+            import pstats
+            self.ProfileLock.acquire()
+            pstats.Stats(self.Profiler).sort_stats("cumulative") \
+                .print_stats(limit)
+            self.ProfileLock.release()
+        if self.TraceMemory:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            for stat in snapshot.statistics("lineno")[0:limit]:
+                print(stat)
+
+
 # Main DataPacker Object... use it as a global object, its thread safe
 class DataPacker:
     # I have list of DataBanks
     RunNumber = -99
     RunStatus = str()
-    PeriodicTasks = list()
     BufferOverflowCount = 0
     TestMode = False
     TestModeBuffer = ""
@@ -153,7 +1177,22 @@ class DataPacker:
                      message,
                      True)
 
+    # Announcements made by the DataPacker itself, these must never raise
+    # a pending DataPackerOverload in its own threads
+    def __Announce(self, category, message):
+        self.__AddData(category,
+                       b"TALK",
+                       b"\0",
+                       0,
+                       0,
+                       GetLVTimeNow(),
+                       message,
+                       self.DataBanks,
+                       True)
+
     def GetRunNumber(self):
+        if not self.Started:
+            raise RuntimeError("Call start() before GetRunNumber()")
         # Launch the periodic task to track the RunNumber
         self.__AddPeriodicRequestTask("GET_RUNNO")
         # Wait until we have a valid RunNumber (happens on first call only)
@@ -162,18 +1201,237 @@ class DataPacker:
         return self.RunNumber
 
     def GetRunStatus(self):
+        if not self.Started:
+            raise RuntimeError("Call start() before GetRunStatus()")
         # Launch the peridoc task to track Run Status
         self.__AddPeriodicRequestTask("GET_STATUS")
         while len(self.RunStatus) == 0:
             time.sleep(0.1)
         return self.RunStatus
 
+    # How often the RunNumber and RunStatus are requested from MIDAS
+    # (independent of how often data is sent)
+    def SetPollInterval(self, seconds):
+        self.Control.PollInterval = seconds
+
+    # Choose what happens when there is more data than fits in one event
+    # (SHED_SPLIT, SHED_DEFER, SHED_DROP or SHED_RAISE)
+    def SetLoadSheddingPolicy(self, policy, max_events_per_flush=10):
+        self.Shedder = LoadShedder(policy, max_events_per_flush)
+
+    # Connect to MIDAS and launch the background threads
+    def start(self):
+        if self.Started:
+            return self
+        assert not self.Closed, "DataPacker is closed"
+        self.StartTime = time.time()
+        self.KillThreads = False
+        self.Stopping.clear()
+        # Connect to LabVIEW frontend 'supervisor'
+        self.PauseLogging = True
+        self.__connect(self.Endpoints[0])
+        self.__run_forever()
+        self.Started = True
+        # Short lived jobs get their last data sent when python exits
+        atexit.register(self.close)
+        return self
+
+    # Stop the background threads (data still in the banks is not sent)
+    def stop(self):
+        if not self.Started:
+            return
+        atexit.unregister(self.close)
+        self.__stop()
+        self.__JoinThreads(time.time() + 10.)
+        self.Started = False
+
+    # Stop taking data, send everything in the banks and wait (up to
+    # timeout seconds) for MIDAS to acknowledge it before stopping the
+    # threads. Returns True if all the data was acknowledged in time
+    def close(self, timeout=10.0):
+        if self.Closed:
+            return True
+        deadline = time.time() + timeout
+        self.Closed = True
+        if not self.Started:
+            if self.__BanksToFlush(self.DataBanks):
+                print("DataPacker closed before start()... " +
+                      "data in the banks is not sent")
+            # Give the memory back to the MemoryBudget
+            for bank in self.DataBanks:
+                bank.Drop()
+            return False
+        atexit.unregister(self.close)
+        # Stop the flush thread, so only this one is packing
+        self.Stopping.set()
+        self.t1.join(max(deadline - time.time(), 0.))
+        # Nothing sent from here on may be dropped from a full backlog
+        dropped = 0
+        for endpoint in self.Endpoints:
+            dropped -= endpoint.DroppedEvents
+        self.QueueDeadline = deadline
+        # Final flush, __Flush leaves whatever does not fit in
+        # MaxEventSize in the banks so this loops until they are empty
+        while (self.__BanksToFlush(self.DataBanks) or
+               self.Control.NumberPending()) and time.time() < deadline:
+            Bundle = self.__Flush(self.DataBanks, self.Control)
+            if not Bundle:
+                # What is left can never fit in an event
+                break
+            self.__SendEvent(Bundle)
+        # Wait for every endpoint to get a reply to everything sent to it
+        while time.time() < deadline:
+            unsent = 0
+            for endpoint in self.Endpoints:
+                unsent += endpoint.Unacknowledged()
+            if unsent == 0:
+                break
+            time.sleep(0.01)
+        self.QueueDeadline = None
+        unsent = self.__BanksToFlush(self.DataBanks)
+        for endpoint in self.Endpoints:
+            unsent += endpoint.Unacknowledged()
+            dropped += endpoint.DroppedEvents
+        if unsent:
+            print("DataPacker closed with " + str(unsent) +
+                  " banks or events not acknowledged by MIDAS")
+        if dropped:
+            print("DataPacker closed with " + str(dropped) +
+                  " events dropped from full backlogs")
+        self.__stop()
+        self.__JoinThreads(deadline)
+        self.Started = False
+        return unsent == 0 and dropped == 0
+
+    # Wait for the background threads to finish (until deadline)
+    def __JoinThreads(self, deadline):
+        for endpoint in self.Endpoints:
+            endpoint.BacklogReady.acquire()
+            endpoint.BacklogReady.notify_all()
+            endpoint.BacklogReady.release()
+        threads = [self.t1]
+        for endpoint in self.Endpoints:
+            threads.append(endpoint.Thread)
+            endpoint.Thread = None
+        for thread in threads:
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(max(deadline - time.time(), 0.))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # [samples in the banks, bytes in the banks, events not yet sent]
+    def QueueDepth(self):
+        samples = 0
+        size = 0
+        for bank in self.DataBanks:
+            samples += bank.NumberToFlush()
+            size += bank.DataLengthOfBank()
+        events = 0
+        for endpoint in self.Endpoints:
+            events += endpoint.Unacknowledged()
+        return array.array('d', [samples, size, events])
+
+    # Send to another MIDAS experiment too (SEND_FANOUT) or use it as a
+    # fallback for the first one (SEND_FAILOVER)
+    def AddEndpoint(self, midas_server, port=12345, timeout=10.0,
+                    max_backlog=100, max_data_rate=0, window=1):
+        endpoint = MidasEndpoint(midas_server,
+                                 port,
+                                 timeout,
+                                 max_backlog,
+                                 max_data_rate,
+                                 window)
+        self.Endpoints.append(endpoint)
+        if self.Started:
+            self.__StartEndpoint(endpoint)
+        return endpoint
+
+    # Limit the bytes one bank can hold (None for no limit), and optionally
+    # use its own eviction policy (see EVICT_*)
+    def SetBankCap(self, category, varname, max_bytes, policy=None):
+        category = CleanString(category, 16)
+        varname = CleanString(varname, 16)
+        self.BankCaps[(category, varname)] = (max_bytes, policy)
+        bank = self.BankIndex.get((category, varname))
+        if bank is not None:
+            [bank.MaxBytes, bank.EvictionPolicy] = [max_bytes, policy]
+
+    # Number of samples evicted from each variable: {(category, varname): n}
+    def EvictionCounts(self):
+        counts = {}
+        for bank in self.DataBanks:
+            if bank.Evicted:
+                counts[(bank.VARCATEGORY, bank.VARNAME)] = bank.Evicted
+        return counts
+
+    # Trace the time samples take from AddData to MIDAS (see TRACE_STAGES),
+    # optionally profiling packing and sending with cProfile and memory
+    # with tracemalloc
+    def EnableTracing(self, profile=False, trace_memory=False,
+                      max_samples=10000):
+        self.DisableTracing()
+        self.Tracer = LatencyTracer(max_samples, profile, trace_memory)
+        for bank in self.DataBanks:
+            bank.StartTracing(self.Tracer)
+
+    def DisableTracing(self):
+        if self.Tracer is None:
+            return
+        for bank in self.DataBanks:
+            bank.StartTracing(None)
+        self.Tracer.Close()
+        self.Tracer = None
+
+    # callback is given a dict of stage durations (and the number of
+    # samples) for every flush cycle acknowledged by MIDAS
+    def AddTraceHook(self, callback):
+        assert self.Tracer is not None, "Call EnableTracing() first"
+        self.Tracer.Hooks.append(callback)
+
+    # Percentiles (default 50, 90, 99) of the sample ages and stage
+    # durations in seconds, None if tracing is off
+    def LatencyReport(self, points=(50, 90, 99)):
+        if self.Tracer is None:
+            return None
+        return self.Tracer.Report(points)
+
+    def PrintProfile(self, limit=20):
+        if self.Tracer is not None:
+            self.Tracer.PrintProfile(limit)
+
+    # Banks with the lowest priority are dropped first by SHED_DROP
+    def SetBankPriority(self, category, varname, priority):
+        category = CleanString(category, 16)
+        varname = CleanString(varname, 16)
+        self.BankPriority[(category, varname)] = priority
+        for bank in self.DataBanks:
+            if bank.IsBankMatch(category, varname):
+                bank.Priority = priority
+
     # The public version of AddData can ONLY queue to self.DataBanks
     def AddData(self, category, varname, description, history_settings,
                 history_rate, timestamp, data, insert_front=False):
+        if self.Closed:
+            raise RuntimeError("DataPacker is closed")
+        if not self.Started and not self.TestMode and \
+                not self.WarnedNotStarted:
+            # Data is kept in the banks, but nothing sends it
+            print("DataPacker not started... call start() to send data " +
+                  "to MIDAS")
+            self.WarnedNotStarted = True
         self.__AddData(category, varname, description, history_settings,
                        history_rate, timestamp, data, self.DataBanks,
                        insert_front)
+        # Report data that could not be sent (SHED_RAISE policy only). This
+        # sample is already queued, so it must not be added again
+        if self.Shedder.Pending is not None:
+            overload = self.Shedder.Pending
+            self.Shedder.Pending = None
+            raise overload
 
     # The private version of AddData can use custom queues (ie for __connect())
     def __AddData(self, category, varname, description, history_settings,
@@ -189,24 +1447,23 @@ class DataPacker:
             self.__LogInTestMode(timestamp, category, varname, data)
         # Convert any lists to an array
         if isinstance(data, list):
-            TYPE = GetListType(type(data[0]))
-            assert TYPE == b"DBL\0", "list support is limited to doubles...\
-                                      please use arrays (or np arrays) \
-                                      for any other data type!"
-            data = array.array('d', data)
-        # If we have Numpy, convert array to byte array
-        if HaveNumpy:
+            [typecode, TYPE] = GetListType(type(data[0]))
+            data = array.array(typecode, data).tobytes()
+        # If numpy is in use, convert array to byte array
+        np = sys.modules.get("numpy")
+        if np is not None:
             # https://docs.scipy.org/doc/numpy/reference/arrays.dtypes.html
             if isinstance(data, np.ndarray):
-                # Convert numpy array to byte array
+                # Convert numpy array to byte array (in native byte order,
+                # which is what the bank header says)
                 TYPE = GetNpArrayType(data.dtype)
-                assert len(TYPE) == 4, str(TYPE)
+                if not data.dtype.isnative:
+                    data = data.astype(data.dtype.newbyteorder('='))
                 data = data.tobytes()
         # Convert python array to byte array
         # https://docs.python.org/3/library/array.html
         if isinstance(data, array.array):
             TYPE = GetArrayType(data.typecode)
-            assert len(TYPE) == 4, str(TYPE)
             # Data need to be encoded as bytes... convert now
             data = data.tobytes()
         # Convert string data to byte array
@@ -218,56 +1475,192 @@ class DataPacker:
             if TYPE == b"NULL":
                 TYPE = b"U8\0\0"
         else:
-            print("Unsupported data format (" +
-                  str(type(data)) +
-                  ")... upgrade DataPacker!")
-            exit(1)
-        if varname != b"TALK" and varname != b"COMMAND":
+            raise TypeError("Unsupported data format (" +
+                            str(type(data)) +
+                            ")... upgrade DataPacker!")
+        if varname == b"TALK" or varname == b"COMMAND":
+            if databanks is self.DataBanks:
+                # Messages for MIDAS go through the control channel
+                self.Control.Add(TYPE,
+                                 category,
+                                 varname,
+                                 description,
+                                 history_settings,
+                                 history_rate,
+                                 timestamp,
+                                 data)
+                return
+        else:
             # Find existing bank to add data to
-            for bank in databanks:
-                if bank.IsBankMatch(category, varname):
-                    # Bank already in memory! Add data to it!
-                    bank.AddData(timestamp, data)
-                    return
+            bank = self.__FindBank(category, varname, databanks)
+            if bank is not None:
+                # Bank already in memory! Add data to it!
+                bank.AddData(timestamp, data)
+                return
         # Matching bank not found in list... add this new bank to
         # DataBanks list
+        bank = self.__NewBank(TYPE,
+                              category,
+                              varname,
+                              description,
+                              history_settings,
+                              history_rate,
+                              databanks,
+                              insert_front)
+        bank.AddData(timestamp, data)
+
+    def __FindBank(self, category, varname, databanks):
+        if databanks is self.DataBanks:
+            return self.BankIndex.get((category, varname))
+        for bank in databanks:
+            if bank.IsBankMatch(category, varname):
+                return bank
+        return None
+
+    def __NewBank(self, TYPE, category, varname, description,
+                  history_settings, history_rate, databanks,
+                  insert_front=False):
         bank = DataBank(TYPE,
                         category,
                         varname,
                         description,
                         history_settings,
                         history_rate)
-        bank.AddData(timestamp, data)
+        bank.Priority = self.BankPriority.get((category, varname), 0)
+        if databanks is self.DataBanks:
+            bank.Budget = self.Memory
+            self.Memory.Track(bank)
+            [bank.MaxBytes, bank.EvictionPolicy] = \
+                self.BankCaps.get((category, varname), (None, None))
+            if self.Tracer is not None:
+                bank.StartTracing(self.Tracer)
         if insert_front:
             databanks.insert(0, bank)
         else:
             databanks.append(bank)
+        if databanks is self.DataBanks and \
+                varname != b"TALK" and varname != b"COMMAND":
+            self.BankIndex[(category, varname)] = bank
+        return bank
+
+    # Pre-bind a variable: the returned VariableHandle logs it with
+    # handle.log(data) without cleaning strings, resolving the data type
+    # or looking up the bank on every call. dtype is an array typecode or
+    # a numpy dtype, shape the number of values (or numpy shape) per sample
+    def variable(self, category, varname, description, dtype, shape,
+                 history_settings=0, history_rate=1):
+        category = CleanString(category, 16)
+        varname = CleanString(varname, 16)
+        description = CleanString(description, 32)
+        if dtype in ArrayTypes:
+            TYPE = ArrayTypes[dtype]
+            itemsize = array.array(dtype).itemsize
+        else:
+            import numpy as np
+            dtype = np.dtype(dtype)
+            TYPE = GetNpArrayType(dtype)
+            itemsize = dtype.itemsize
+        n = shape
+        if isinstance(shape, tuple):
+            n = 1
+            for size in shape:
+                n *= size
+        payload_size = n * itemsize
+        bank = self.__FindBank(category, varname, self.DataBanks)
+        if bank is None:
+            bank = self.__NewBank(TYPE,
+                                  category,
+                                  varname,
+                                  description,
+                                  history_settings,
+                                  history_rate,
+                                  self.DataBanks)
+        if bank.DATATYPE != TYPE:
+            raise ValueError("Variable " + str(varname) + " is already " +
+                             "logged as " + str(bank.DATATYPE))
+        # Samples already added with AddData fix the size too
+        bank.r.acquire()
+        record_size = bank.RecordSize
+        if record_size is None and len(bank.DataList):
+            record_size = len(bank.DataList[0])
+        if record_size is None or record_size == 16 + payload_size:
+            bank.RecordSize = 16 + payload_size
+        bank.r.release()
+        if bank.RecordSize != 16 + payload_size:
+            raise ValueError("Variable " + str(varname) + " is already " +
+                             "logged with " + str(record_size - 16) +
+                             " bytes per sample")
+        return VariableHandle(self, bank, payload_size,
+                              (category, varname, description, dtype, shape,
+                               history_settings, history_rate))
 
     # Private member functions
-    def __init__(self, midas_server, port = 12345, max_data_rate = 0):
-        self.experiment = midas_server
-        self.initial_port = port
-        self.port = port
+    def __init__(self, midas_server, port = 12345, max_data_rate = 0,
+                 shed_policy = SHED_DEFER, send_mode = SEND_FANOUT,
+                 timeout = 10.0, window = 1):
+        assert send_mode in (SEND_FANOUT, SEND_FAILOVER), \
+            "Unknown send mode (" + str(send_mode) + ")"
+        self.SendMode = send_mode
+        self.Endpoints = []
+        self.MyHostName = socket.gethostname()
         self.DataBanks = []
         self.BankArrayID = 0
         self.MaxEventSize = max_data_rate
-        # Connect to LabVIEW frontend 'supervisor'
-        self.__connect()
-        self.__run_forever()
-
-    def __connect(self):
+        self.Shedder = LoadShedder(shed_policy)
+        self.BankPriority = {}
+        # Memory held by the banks is limited by the process wide budget
+        self.Memory = GetMemoryBudget()
+        self.BankCaps = {}
+        # LatencyTracer, when EnableTracing() is used
+        self.Tracer = None
+        # COMMAND and TALK messages
+        self.Control = ControlChannel()
+        # Banks in DataBanks by (category, varname), COMMAND and TALK
+        # banks are not in here (they are never shared)
+        self.BankIndex = {}
+        # Banks that did not fit in the last event built by __Flush
+        self.OverflowBanks = []
+        self.FlushLock = threading.RLock()
+        self.KillThreads = False
         self.PauseLogging = True
-        print("Connecting to MIDAS server...")
+        # Set to wake up and stop the flush and load logging threads
+        self.Stopping = threading.Event()
+        self.t1 = None
+        # Host load is sampled by the flush thread
+        self.Telemetry = GetTelemetrySampler()
+        self.TelemetrySample = 0
+        self.LastQueueSample = time.monotonic()
+        self.LastLatencySample = time.monotonic()
+        # Nothing connects or runs until start() is called
+        self.Started = False
+        self.WarnedNotStarted = False
+        self.Closed = False
+        self.StartTime = None
+        self.TimeToFirstFlush = None
+        # Set by close(), events then wait for space in full backlogs
+        self.QueueDeadline = None
+        # Counts the times the banks were cleared (see VariableHandle)
+        self.Generation = 0
+        self.Endpoints.append(MidasEndpoint(midas_server,
+                                            port,
+                                            timeout,
+                                            max_data_rate=max_data_rate,
+                                            window=window))
+
+    def __connect(self, endpoint):
+        print("Connecting to MIDAS server " + endpoint.Name() + "...")
         # self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # self.socket.connect((self.experiment,5555))
         print("Connection made... Requesting to start logging")
         ConnectBanks = []
         # Negociate connection to worker frontend
-        self.FrontendStatus = ""
-        self.address = self.experiment
-        self.port = self.initial_port
-        while len(self.FrontendStatus) == 0:
-            self.MyHostName = socket.gethostname()
+        endpoint.Connected = False
+        endpoint.FrontendStatus = ""
+        endpoint.address = endpoint.experiment
+        endpoint.port = endpoint.initial_port
+        while len(endpoint.FrontendStatus) == 0:
+            if self.KillThreads:
+                return
             self.__AddData("THISHOST",
                            "COMMAND",
                            "START_FRONTEND",
@@ -302,21 +1695,26 @@ class DataPacker:
                            GetLVTimeNow(),
                            self.MyHostName,
                            databanks=ConnectBanks)
-            self.__SendWithTimeout(self.__Flush(ConnectBanks), 1000)
+            if not self.__SendWithTimeout(endpoint,
+                                          self.__Flush(ConnectBanks),
+                                          1000):
+                time.sleep(1.)
 
         # Connect to LabVIEW frontend 'worker' (where we send data)
         # Request the max data pack size
-        if self.MaxEventSize:
+        if endpoint.RequestedEventSize:
             self.__AddData("THISHOST",
                            "COMMAND",
                            "SET_EVENT_SIZE",
                            0,
                            0,
                            GetLVTimeNow(),
-                           str(self.MaxEventSize),
+                           str(endpoint.RequestedEventSize),
                            databanks=ConnectBanks)
-        self.MaxEventSize = -1
-        while self.MaxEventSize < 0:
+        endpoint.MaxEventSize = -1
+        while endpoint.MaxEventSize < 0:
+            if self.KillThreads:
+                return
             self.__AddData("THISHOST",
                            "COMMAND",
                            "GET_EVENT_SIZE",
@@ -325,60 +1723,100 @@ class DataPacker:
                            GetLVTimeNow(),
                            str("\0"),
                            databanks=ConnectBanks)
-            self.__SendWithTimeout(self.__Flush(ConnectBanks))
+            if not self.__SendWithTimeout(endpoint,
+                                          self.__Flush(ConnectBanks),
+                                          endpoint.Timeout):
+                time.sleep(1.)
+        endpoint.Connected = True
+        endpoint.Healthy = True
+        self.__UpdateEventSize()
         print("MaxEventSize:" + str(self.MaxEventSize))
         # Announce I am connection on MIDAS speaker
         connectMsg = "New python connection from " + \
                      self.MyHostName + \
                      " PROGRAM:" + str(sys.argv)
         print(connectMsg)
-        self.AnnounceOnSpeaker("THISHOST", connectMsg)
-        self.PauseLogging = False
+        self.__Announce("THISHOST", connectMsg)
+
+    # Events are packed once, so they must fit in every endpoint
+    def __UpdateEventSize(self):
+        sizes = [endpoint.MaxEventSize for endpoint in self.Endpoints
+                 if endpoint.Connected and endpoint.MaxEventSize >= 0]
+        if len(sizes):
+            self.MaxEventSize = min(sizes)
+
+    # The endpoint RunNumber, RunStatus and MIDASTime are reported from
+    def __PrimaryEndpoint(self):
+        if self.SendMode == SEND_FAILOVER:
+            for endpoint in self.Endpoints:
+                if endpoint.Healthy:
+                    return endpoint
+        return self.Endpoints[0]
 
     def __run_forever(self):
         # Start background thread to flush data
         self.KillThreads = False
         self.PauseLogging = False
-        self.t1 = threading.Thread(target=self.__Run)
+        self.t1 = threading.Thread(target=self.__Run,
+                                   name="MIDAS_GEM flush",
+                                   daemon=True)
         self.t1.start()
-        # Start lightweight background thread to log CPU load
-        if HavePsutil:
-            self.t2 = threading.Thread(target=self.__LogLoad)
-            self.t2.start()
+        # Start one thread per endpoint to send the packed data
+        for endpoint in self.Endpoints:
+            self.__StartEndpoint(endpoint)
         print("Polling thread launched")
 
+    def __StartEndpoint(self, endpoint):
+        if endpoint.Thread is None:
+            endpoint.Thread = threading.Thread(target=self.__SendLoop,
+                                               args=(endpoint,),
+                                               name="MIDAS_GEM send " +
+                                               endpoint.Name(),
+                                               daemon=True)
+            endpoint.Thread.start()
+
     def __stop(self):
         print("Stopping...")
+        self.Stopping.set()
         self.KillThreads = True
-        print("Closing socket")
-        # self.socket.disconnect(self.address)
-        self.socket.close()
         print("Clearing list")
+        for bank in self.DataBanks:
+            bank.Drop()
         self.DataBanks = []
+        self.BankIndex = {}
+        # VariableHandles bound to the old banks bind to new ones
+        self.Generation += 1
         # self.context.destroy()
         print("done")
 
-    # Log CPU load and memory usage once per minute
-    def __LogLoad(self):
-        while True:
-            CPUMEM = psutil.cpu_percent(interval=60, percpu=True)
-            CPUMEM.append(psutil.virtual_memory().percent)
-            # print("Logging CPUMEM "+str(CPUMEM))
-            self.AddData("THISHOST",
-                         "CPUMEM",
-                         "",
-                         0,
-                         10,
-                         GetLVTimeNow(),
-                         CPUMEM)
-            if self.KillThreads:
-                break
+    # Log host load and queue depth (polled by the flush thread)
+    def __LogTelemetry(self):
+        [self.TelemetrySample, logs] = \
+            self.Telemetry.Poll(self.TelemetrySample)
+        now = time.monotonic()
+        if "queue" in self.Telemetry.Metrics and \
+                now - self.LastQueueSample >= self.Telemetry.Interval:
+            self.LastQueueSample = now
+            logs.append(("QUEUE", self.QueueDepth()))
+        # Latency is logged at the telemetry interval (when telemetry is on)
+        if self.Tracer is not None and len(self.Telemetry.Metrics) and \
+                now - self.LastLatencySample >= self.Telemetry.Interval:
+            self.LastLatencySample = now
+            logs.append(("LATENCY", self.Tracer.Record()))
+        for varname, data in logs:
+            self.__AddData("THISHOST",
+                           varname,
+                           "",
+                           0,
+                           10,
+                           GetLVTimeNow(),
+                           data,
+                           self.DataBanks)
 
-    # Add a task that is called once per second (eg track RunNumber).
+    # Add a task that is called every poll interval (eg track RunNumber).
     # (Is private function)
     def __AddPeriodicRequestTask(self, task):
-        if task not in self.PeriodicTasks:
-            self.PeriodicTasks.append(task)
+        self.Control.AddPeriodicTask(task)
 
     # Tool to dump out all logged data to a local file
     def __LogInTestMode(self, timestamp, category, varname, data):
@@ -404,8 +1842,95 @@ class DataPacker:
                 n += 1
         return n
 
-    # Flatten all data in memory (to send to MIDAS)
-    def __Flush(self, databanks):
+    # Count a shed event and log it in the LOADSHED bank
+    def __RecordShed(self, kind, n_bytes, n_dropped=0):
+        self.__AddData("THISHOST",
+                       "LOADSHED",
+                       "Load shedding events",
+                       0,
+                       0,
+                       GetLVTimeNow(),
+                       self.Shedder.Record(kind, n_bytes, n_dropped),
+                       self.DataBanks)
+
+    # Deal with data left in the banks after a flush (see SHED_* policies)
+    def __ShedBacklog(self):
+        if len(self.OverflowBanks) == 0:
+            return
+        policy = self.Shedder.Policy
+        backlog = 0
+        for bank in self.OverflowBanks:
+            backlog += bank.DataLengthOfBank()
+        if policy == SHED_SPLIT:
+            # Keep sending events until the overflow is gone
+            events = 1
+            while len(self.OverflowBanks) and \
+                    events < self.Shedder.MaxEventsPerFlush:
+                Bundle = self.__Flush(self.DataBanks)
+                if not Bundle:
+                    break
+                self.__SendEvent(Bundle)
+                events += 1
+            self.__RecordShed(SHED_SPLIT, backlog)
+        elif policy == SHED_DROP:
+            self.__DropLowestPriority()
+        elif policy == SHED_RAISE:
+            self.__RecordShed(SHED_RAISE, backlog)
+            self.Shedder.Pending = DataPackerOverload(backlog,
+                                                      self.MaxEventSize,
+                                                      "Backlog after flush")
+        else:
+            self.__RecordShed(SHED_DEFER, backlog)
+
+    # Drop the backlog of the lowest priority banks until the rest fits
+    # in the next event
+    def __DropLowestPriority(self):
+        buffer_remaining = 10000  # Same default as __Flush
+        if self.MaxEventSize > 0:
+            buffer_remaining = self.MaxEventSize
+        banks = [bank for bank in self.DataBanks if bank.NumberToFlush()]
+        backlog = 0
+        for bank in banks:
+            backlog += bank.DataLengthOfBank()
+        dropped_bytes = 0
+        dropped_samples = 0
+        for bank in sorted(banks, key=lambda bank: bank.Priority):
+            if backlog <= buffer_remaining:
+                break
+            size = bank.DataLengthOfBank()
+            dropped_samples += bank.Drop()
+            dropped_bytes += size
+            backlog -= size
+        if dropped_samples:
+            self.__RecordShed(SHED_DROP, dropped_bytes, dropped_samples)
+
+    # Flatten all data in memory (to send to MIDAS), with the messages
+    # waiting in control (a ControlChannel) at the front
+    def __Flush(self, databanks, control=None):
+        # Endpoint threads pack their connection requests here too
+        self.FlushLock.acquire()
+        try:
+            if self.BufferOverflowCount > 100:
+                self.__Announce("THISHOST",
+                                "DataPacker on " + self.MyHostName +
+                                " limited by data rate for more than a minute")
+                self.BufferOverflowCount = 0
+            tracer = self.Tracer
+            if tracer is None:
+                return self.__FlushLocked(databanks, control)
+            pack_start = time.monotonic()
+            event = tracer.Profiled(self.__FlushLocked, databanks, control)
+            if event:
+                tracer.Event(event, pack_start, time.monotonic())
+            return event
+        finally:
+            self.FlushLock.release()
+
+    def __FlushLocked(self, databanks, control):
+        [control_lump, control_banks] = [b'', 0]
+        if control is not None:
+            [control_lump, control_banks] = control.Take()
+        self.OverflowBanks = []
         # Decrement the buffer overflow counter once per second until =0
         if self.BufferOverflowCount > 0:
             self.BufferOverflowCount = self.BufferOverflowCount-1
@@ -414,22 +1939,31 @@ class DataPacker:
         if self.MaxEventSize > 0:
             buffer_remaining = self.MaxEventSize
         # If data packer has no banks... do nothing
-        if len(databanks) == 0:
+        if len(databanks) == 0 and control_banks == 0:
             return
-        # If data packer has one bank, flush it
-        if len(databanks) == 1:
-            return databanks[0].Flush(self, buffer_remaining)
-        # If data packer only has one bank type to flush... flush it
-        if self.__BanksToFlush(databanks) == 1:
-            for bank in databanks:
-                if bank.NumberToFlush() > 0:
-                    return bank.Flush(self, buffer_remaining)
+        # Pipelined replies are matched by BankArrayID, so every event
+        # needs to be a super bank
+        pipelined = self.__Pipelined()
+        if control_banks:
+            # If there is only one control message, send it on its own
+            if control_banks == 1 and not pipelined and \
+                    self.__BanksToFlush(databanks) == 0:
+                return control_lump
+        elif not pipelined:
+            # If data packer has one bank, flush it
+            if len(databanks) == 1:
+                return databanks[0].Flush(self, buffer_remaining)
+            # If data packer only has one bank type to flush... flush it
+            if self.__BanksToFlush(databanks) == 1:
+                for bank in databanks:
+                    if bank.NumberToFlush() > 0:
+                        return bank.Flush(self, buffer_remaining)
         # If data packer has many banks to flush, put them in a superbank
         # Track remaining buffer space, less the size of a bank array header
-        buffer_remaining = buffer_remaining-16
+        # and the control messages (which go first)
+        buffer_remaining = buffer_remaining-16-len(control_lump)
         print("Building super bank")
-        lump = b''
-        number_of_banks = 0
+        banks = []
         # Loop over all banks and flush each one
         for bank in databanks:
             n_to_flush = bank.NumberToFlush()
@@ -438,158 +1972,412 @@ class DataPacker:
             bank = bank.Flush(self, buffer_remaining)
             if len(bank):
                 buffer_remaining = buffer_remaining-len(bank)
-                lump = struct.pack('{}s{}s'.format(len(lump),
-                                                   len(bank)),
-                                   lump,
-                                   bank)
-                number_of_banks += 1
+                banks.append(bank)
+        lump = b''.join([control_lump] + banks)
+        number_of_banks = control_banks + len(banks)
+        print("Size of lump in super bank:" + str(len(lump)) +
+              "(" + str(number_of_banks) + " banks)")
+        return self.__SuperBank(lump, number_of_banks)
+
+    # Add the bank array header (with the next BankArrayID) to banks
+    def __SuperBank(self, lump, number_of_banks):
+        self.FlushLock.acquire()
         super_bank = struct.pack('4sIII{}s'.format(len(lump)),
                                  b"GEA1",
                                  self.BankArrayID,
                                  len(lump),
                                  number_of_banks,
                                  lump)
-        self.BankArrayID = self.BankArrayID+1
-        print("Size of lump in super bank:" + str(len(lump)) +
-              "(" + str(number_of_banks) + " banks)")
+        self.BankArrayID = (self.BankArrayID+1) % pow(2, 32)
+        self.FlushLock.release()
         return super_bank
 
-    # Parse the json string MIDAS sends as a reply to data
-    def __HandleReply(self, reply):
-        # Unfold the json string into a dictionary
-        ReplyList = json.loads(reply)
+    def __Pipelined(self):
+        for endpoint in self.Endpoints:
+            if endpoint.Window > 1:
+                return True
+        return False
+
+    # Act on the (already unfolded) json reply MIDAS sends to data
+    def __HandleReply(self, endpoint, ReplyList):
         # print(ReplyList)
+        primary = endpoint is self.__PrimaryEndpoint()
         if 'RunNumber' in ReplyList:
-            self.RunNumber = int(ReplyList['RunNumber'])
+            endpoint.RunNumber = int(ReplyList['RunNumber'])
+            if primary:
+                self.RunNumber = endpoint.RunNumber
         if 'EventSize' in ReplyList:
-            self.MaxEventSize = int(ReplyList['EventSize'])
+            endpoint.MaxEventSize = int(ReplyList['EventSize'])
+            self.__UpdateEventSize()
         if 'RunStatus' in ReplyList:
-            self.RunStatus = ReplyList['RunStatus']
+            endpoint.RunStatus = ReplyList['RunStatus']
+            if primary:
+                self.RunStatus = endpoint.RunStatus
         if 'SendToAddress' in ReplyList:
-            self.address = ReplyList['SendToAddress']
+            endpoint.address = ReplyList['SendToAddress']
         if 'SendToPort' in ReplyList:
-            self.port = int(ReplyList['SendToPort'])
+            endpoint.port = int(ReplyList['SendToPort'])
         if 'FrontendStatus' in ReplyList:
-            self.FrontendStatus = ReplyList['FrontendStatus']
-        if 'MIDASTime' in ReplyList:
+            endpoint.FrontendStatus = ReplyList['FrontendStatus']
+        if 'MIDASTime' in ReplyList and primary:
             self.MIDASTime = float(ReplyList['MIDASTime'])
         if 'msg' in ReplyList:
             print(ReplyList['msg'])
         if 'err' in ReplyList:
             print(ReplyList['err'])
 
-    def __send_block(self, message, response_size, timeout_limit=10.0):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(timeout_limit)
-        self.socket.connect((self.experiment, self.port))
-        self.socket.sendall(message)
-        response = b""
-        bracket_counter = int(0)
+    def __send_block(self, endpoint, message, response_size,
+                     timeout_limit=10.0):
+        endpoint.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        endpoint.socket.settimeout(timeout_limit)
+        send_start = time.monotonic()
+        endpoint.socket.connect((endpoint.experiment, endpoint.port))
+        endpoint.socket.sendall(message)
+        if self.Tracer is not None:
+            self.Tracer.Sent(message, send_start, time.monotonic())
         # Read reponse back
-        response += self.socket.recv(response_size)
-        # Track brackets, json message is complete when bracket_counter = 0
-        bracket_counter += response.count(b"{")
-        bracket_counter -= response.count(b"}")
-        # Read until end of json message
-        while bracket_counter > 0:
-            more = self.socket.recv(response_size)
-            bracket_counter += more.count(b"{")
-            bracket_counter -= more.count(b"}")
-            response += more
-            # print(response)
-        self.socket.shutdown(socket.SHUT_WR)
-        self.socket.close()
+        response = ReplyReader(endpoint.socket, response_size,
+                               single_reply=True).Read()
+        endpoint.socket.shutdown(socket.SHUT_WR)
+        endpoint.socket.close()
         return response
 
-    # Send formatted data to MIDAS
-    def __SendWithTimeout(self, data, timeout_limit=10.0):
+    # Send formatted data to one MIDAS endpoint, returns False if it
+    # needs sending again
+    def __SendWithTimeout(self, endpoint, data, timeout_limit=10.0):
         reply = ""
         try:
-            reply = self.__send_block(data, 1024, timeout_limit)
+            reply = self.__send_block(endpoint, data, 1024, timeout_limit)
         except socket.timeout:
             # self.AnnounceOnSpeaker("TCPTimeout", "Connection drop detected...")
-            print("Failed to send after "+str(timeout_limit)+" seconds")
+            print("Failed to send to " + endpoint.Name() + " after " +
+                  str(timeout_limit) + " seconds")
+            return False
         except ConnectionResetError:
             print("Connection got reset... trying to again...")
-            # self.__connect()
-            self.__SendWithTimeout(data, timeout_limit)
+            return False
         except ConnectionRefusedError:
             print("Connection got refused... trying to connnect...")
-            time.sleep(1.)
-            if self.port != self.initial_port:
-                self.__connect()
-            self.__SendWithTimeout(data, timeout_limit)
+            if endpoint.port != endpoint.initial_port:
+                # Worker frontend has gone, negociate a new one
+                endpoint.Connected = False
+            return False
         except OSError:
             print("OSError... check firewall settings of MIDAS server")
+            return False
         except Exception:
             print("New unknown exception!!!", sys.exc_info()[0])
-            exit(1)
-        if len(reply):
-            self.__HandleReply(reply)
-            if reply[0:5] == b"ERROR":
-                print("ERROR reported from MIDAS! FATAL!")
-                os._exit(1)
+            return False
+        if isinstance(reply, bytes) and reply[0:5] == b"ERROR":
+            self.__Rejected(reply, data)
+            return True
+        if isinstance(reply, dict):
+            self.__HandleReply(endpoint, reply)
         # print("Sent on attempt"+str(send_attempt))
         print("Data sent and received reply:"+str(reply))
-        return
+        return True
+
+    # Send the backlog of one endpoint... run as its own thread
+    def __SendLoop(self, endpoint):
+        while not self.KillThreads:
+            if not endpoint.Connected:
+                self.__connect(endpoint)
+                continue
+            if endpoint.Window > 1:
+                sent = self.__SendPipelined(endpoint)
+            else:
+                sent = self.__SendNext(endpoint)
+            if sent:
+                continue
+            endpoint.Healthy = False
+            if self.SendMode == SEND_FAILOVER:
+                # Move the backlog to a healthy endpoint, then negociate
+                # the connection to this one again
+                self.__Failover(endpoint)
+                endpoint.Connected = False
+            else:
+                time.sleep(1.)
+        # Stopped... events in flight go back to the backlog
+        self.__ClosePipe(endpoint)
+
+    # Send the oldest event in the backlog on its own connection, returns
+    # False if it failed
+    def __SendNext(self, endpoint):
+        event = endpoint.Next(0.1)
+        if event is None:
+            return True
+        tracer = self.Tracer
+        if tracer is None:
+            sent = self.__SendWithTimeout(endpoint, event, endpoint.Timeout)
+        else:
+            sent = tracer.Profiled(self.__SendWithTimeout, endpoint, event,
+                                   endpoint.Timeout)
+        if not sent:
+            return False
+        endpoint.Sent(event)
+        if tracer is not None:
+            tracer.Acknowledged(event)
+        endpoint.Healthy = True
+        return True
+
+    # Keep up to endpoint.Window events in flight on one connection and
+    # handle one reply, returns False if the connection failed (the events
+    # in flight are then sent again on the next connection)
+    def __SendPipelined(self, endpoint):
+        try:
+            if endpoint.Pipe is None:
+                endpoint.socket = socket.socket(socket.AF_INET,
+                                                socket.SOCK_STREAM)
+                endpoint.socket.settimeout(endpoint.Timeout)
+                endpoint.socket.connect((endpoint.experiment, endpoint.port))
+                endpoint.Pipe = ReplyReader(endpoint.socket)
+            # Fill the window, only wait for new events if none are in flight
+            while len(endpoint.InFlight) < endpoint.Window:
+                wait = 0.
+                if len(endpoint.InFlight) == 0:
+                    wait = 0.1
+                event = endpoint.Launch(wait)
+                if event is None:
+                    break
+                send_start = time.monotonic()
+                endpoint.socket.sendall(event)
+                if self.Tracer is not None:
+                    self.Tracer.Sent(event, send_start, time.monotonic())
+            if len(endpoint.InFlight) == 0:
+                return True
+            reply = endpoint.Pipe.Read()
+        except ConnectionRefusedError:
+            print("Connection got refused... trying to connnect...")
+            if endpoint.port != endpoint.initial_port:
+                # Worker frontend has gone, negociate a new one
+                endpoint.Connected = False
+            self.__ClosePipe(endpoint)
+            return False
+        except Exception:
+            print("Pipelined connection to " + endpoint.Name() +
+                  " failed:", sys.exc_info()[1])
+            self.__ClosePipe(endpoint)
+            return False
+        endpoint.Healthy = True
+        if isinstance(reply, dict):
+            event = endpoint.Acknowledge(reply.get('BankArrayID'))
+            self.__HandleReply(endpoint, reply)
+        else:
+            event = endpoint.Acknowledge()
+            if reply[0:5] == b"ERROR" and event is not None:
+                self.__Rejected(reply, event)
+        if self.Tracer is not None and event is not None:
+            self.Tracer.Acknowledged(event)
+        return True
+
+    # MIDAS rejected the data... keep running without it
+    def __Rejected(self, reply, data):
+        print("ERROR reported from MIDAS! " + str(reply))
+        if self.Tracer is not None:
+            self.Tracer.Forget(data)
+        self.__RecordShed("reject", len(data))
+        if self.Shedder.Policy == SHED_RAISE:
+            self.Shedder.Pending = DataPackerOverload(len(data),
+                                                      self.MaxEventSize,
+                                                      str(reply))
+
+    # Drop the pipelined connection, events in flight will be sent again
+    def __ClosePipe(self, endpoint):
+        endpoint.Requeue()
+        if endpoint.Pipe is not None:
+            endpoint.Pipe = None
+            endpoint.socket.close()
+
+    # Move the backlog of a failed endpoint to the first healthy one
+    def __Failover(self, endpoint):
+        events = endpoint.TakeBacklog()
+        target = endpoint
+        for other in self.Endpoints:
+            if other.Healthy:
+                target = other
+                break
+        if target is not endpoint:
+            print("Failing over from " + endpoint.Name() +
+                  " to " + target.Name())
+        # With nowhere else to go, the events wait for this endpoint
+        for event in events:
+            target.Queue(event)
+
+    # Hand a packed event to the endpoint threads
+    def __Dispatch(self, event):
+        if self.SendMode == SEND_FAILOVER:
+            target = self.__PrimaryEndpoint()
+            if target.Healthy:
+                # Collect anything stranded on endpoints that went down
+                # before there was a healthy one to fail over to
+                for endpoint in self.Endpoints:
+                    if not endpoint.Healthy:
+                        for stranded in endpoint.TakeBacklog():
+                            target.Queue(stranded, self.QueueDeadline)
+            target.Queue(event, self.QueueDeadline)
+            return
+        for endpoint in self.Endpoints:
+            endpoint.Queue(event, self.QueueDeadline)
 
+    # Returns True if an event of this length can be sent to MIDAS
     def CheckDataLength(self, length):
-        if length > self.MaxEventSize:
-            print("Safety limit! \
-                  You are logging too much data too fast (" +
-                  str(length/1000) + "kbps>" +
-                  str(self.MaxEventSize/1000) +
-                  "kbps)... increase this threshold in the odb")
-            os._exit(1)
+        if length <= self.MaxEventSize:
+            return True
+        print("Safety limit! \
+              You are logging too much data too fast (" +
+              str(length/1000) + "kbps>" +
+              str(self.MaxEventSize/1000) +
+              "kbps)... increase this threshold in the odb")
+        if self.Shedder.Policy == SHED_RAISE:
+            raise DataPackerOverload(length, self.MaxEventSize,
+                                     "Event too large")
+        return False
+
+    # Send one event, splitting it if it is larger than MaxEventSize
+    def __SendEvent(self, Bundle):
+        if not Bundle:
+            return
+        try:
+            fits = self.CheckDataLength(len(Bundle))
+        except DataPackerOverload as overload:
+            # Still send the data, the exception is raised in AddData
+            self.__RecordShed(SHED_RAISE, len(Bundle))
+            self.Shedder.Pending = overload
+            fits = False
+        if fits:
+            self.__Dispatch(Bundle)
+            return
+        if self.Shedder.Policy == SHED_DROP:
+            if self.Tracer is not None:
+                self.Tracer.Forget(Bundle)
+            self.__RecordShed(SHED_DROP, len(Bundle))
+            return
+        self.__RecordShed(SHED_SPLIT, len(Bundle))
+        pipelined = self.__Pipelined()
+        max_size = self.MaxEventSize
+        if pipelined:
+            # Leave space for the bank array header
+            max_size -= 16
+        for event in SplitBundle(Bundle, max_size):
+            if pipelined:
+                event = self.__SuperBank(event, 1)
+            if self.Tracer is not None:
+                # The samples are acknowledged with the last event
+                self.Tracer.Split(Bundle, event)
+                Bundle = event
+            self.__Dispatch(event)
 
     # Main (forever) loop for flushing the queues... run as its own thread
     def __Run(self, periodic_flush_time=1):
         sleep_time = periodic_flush_time
+        next_flush = time.time()
         # Run forever!
-        while True:
+        while not self.Stopping.is_set():
             if self.PauseLogging:
-                time.sleep(0.1)
+                self.Stopping.wait(0.1)
                 continue
             packing_start = time.time()
-            # Execute periodic tasks (RunNumber tracking etc)
-            for task in self.PeriodicTasks:
-                self.AddData(b"THISHOST",
-                             "COMMAND",
-                             bytes(task, 'utf-8'),
-                             0,
-                             0,
-                             GetLVTimeNow(),
-                             str("\0"))
-            # Flatten data in memory and send to MIDAS (if there is any data)
-            n = self.__BanksToFlush(self.DataBanks)
-            if n > 0:
-                Bundle = self.__Flush(self.DataBanks)
-                packing_stop = time.time()
-                self.CheckDataLength(len(Bundle))
-                self.percent_time_packing = \
-                    100. * (packing_stop - packing_start) / sleep_time
-                print("Packing time percentage:" +
-                      str(self.percent_time_packing) + "%")
-                # if (self.percent_time_packing>100.):
-                #    self.AnnounceOnSpeaker("THISHOST",
-                #                           "Warning: \
-                #                           Packing time exceeds 100%")
-                # print("sleeping:" +
-                #       str(sleep_time - (packing_stop - packing_start)))
-                wait_time = sleep_time-(packing_stop-packing_start)
-                if wait_time > 0:
-                    time.sleep(wait_time)
-                print("Sending " + str(n) +
-                      " banks of data (" + str(len(Bundle)) + " bytes)...")
-                # self.socket.send(Bundle)
-                # print("Sent...")
-                self.__SendWithTimeout(Bundle, 10.0)
-                continue
+            # Queue periodic tasks (RunNumber tracking etc), they have
+            # their own cadence
+            self.Control.Poll(packing_start)
+            if packing_start < next_flush:
+                # Woken up between data flushes for the periodic tasks,
+                # only send the control messages
+                if self.Control.NumberPending():
+                    self.__SendEvent(self.__Flush([], self.Control))
             else:
-                print("Nothing to flush")
-            if self.KillThreads:
-                break
-            time.sleep(sleep_time)
+                next_flush = packing_start + sleep_time
+                self.__LogTelemetry()
+                self.__FlushAndSend(packing_start, sleep_time)
+            # Send straight away, then sleep for the rest of the period
+            # print("sleeping:" +
+            #       str(sleep_time - (packing_stop - packing_start)))
+            wait_time = min(next_flush, self.Control.NextPoll()) - \
+                time.time()
+            if wait_time > 0:
+                self.Stopping.wait(wait_time)
+
+    # Flatten data in memory and send to MIDAS (if there is any data)
+    def __FlushAndSend(self, packing_start, sleep_time):
+        n = self.__BanksToFlush(self.DataBanks)
+        if n == 0 and self.Control.NumberPending() == 0:
+            print("Nothing to flush")
+            return
+        Bundle = self.__Flush(self.DataBanks, self.Control)
+        packing_stop = time.time()
+        self.percent_time_packing = \
+            100. * (packing_stop - packing_start) / sleep_time
+        print("Packing time percentage:" +
+              str(self.percent_time_packing) + "%")
+        # if (self.percent_time_packing>100.):
+        #    self.AnnounceOnSpeaker("THISHOST",
+        #                           "Warning: \
+        #                           Packing time exceeds 100%")
+        print("Sending " + str(n) +
+              " banks of data (" + str(len(Bundle)) + " bytes)...")
+        # self.socket.send(Bundle)
+        # print("Sent...")
+        self.__SendEvent(Bundle)
+        self.__ShedBacklog()
+        if self.TimeToFirstFlush is None:
+            self.TimeToFirstFlush = time.time() - self.StartTime
+            print("Time to first flush:" +
+                  str(self.TimeToFirstFlush) + "s")
+
+
+# A variable bound to its DataBank by DataPacker.variable(). Everything
+# that does not change from one sample to the next is worked out once
+class VariableHandle:
+    def __init__(self, packer, bank, payload_size, arguments):
+        self.Packer = packer
+        self.Bank = bank
+        self.PayloadSize = payload_size
+        # The banks are cleared when the packer stops, the arguments of
+        # variable() are kept to find (or make) the bank again
+        self.Arguments = arguments
+        self.Generation = packer.Generation
+        # Precompiled LVDATA format for this size of data
+        self.LVDATA = struct.Struct('16s{}s'.format(payload_size))
+
+    # Log one sample (array, numpy array or bytes of the bound type and
+    # shape). The timestamp defaults to now
+    def log(self, data, timestamp=None):
+        # Check the type first, AddData would take any type of this size
+        if isinstance(data, array.array):
+            if ArrayTypes.get(data.typecode) != self.Bank.DATATYPE:
+                raise TypeError("Expected " + str(self.Bank.DATATYPE) +
+                                " data, got array('" + data.typecode + "')")
+        elif not isinstance(data, (bytes, bytearray)):
+            if NpArrayTypes.get((data.dtype.kind, data.dtype.itemsize)) != \
+                    self.Bank.DATATYPE:
+                raise TypeError("Expected " + str(self.Bank.DATATYPE) +
+                                " data, got " + str(data.dtype))
+            # The bank header says native byte order (as in AddData)
+            if not data.dtype.isnative:
+                data = data.astype(data.dtype.newbyteorder('='))
+        packer = self.Packer
+        if self.Generation != packer.Generation:
+            self.Bank = packer.variable(*self.Arguments).Bank
+            self.Generation = packer.Generation
+        if packer.Closed or packer.TestMode or not packer.Started or \
+                packer.Shedder.Pending is not None:
+            # Let AddData refuse the data, warn, raise or log it to file
+            packer.AddData(self.Bank.VARCATEGORY,
+                           self.Bank.VARNAME,
+                           self.Bank.EQTYPE,
+                           self.Bank.HistorySettings,
+                           self.Bank.HistoryRate,
+                           timestamp or GetLVTimeNow(),
+                           data)
+            return
+        if timestamp is None:
+            timestamp = GetLVTimeNow()
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.tobytes()
+        if len(data) != self.PayloadSize:
+            raise ValueError("Expected " + str(self.PayloadSize) +
+                             " bytes of data, got " + str(len(data)))
+        self.Bank.AddRecord(self.LVDATA.pack(timestamp, data))
 
 
 class DataBank:
@@ -598,6 +2386,10 @@ class DataBank:
     LVBANKHEADERSIZE = 88
     # LVBANK Header format
     LVBANK = '4s4s16s16s32shhhhii{}s'
+    # The part of the LVBANK header that never changes for a bank, and
+    # the block size and count that follow it
+    LVBANKPREFIX = struct.Struct('4s4s16s16s32shhhh')
+    LVBANKBLOCKS = struct.Struct('ii')
     # LVDATA Header format
     LVDATA = '16s{}s'
     r = threading.RLock()
@@ -616,7 +2408,29 @@ class DataBank:
         self.EQTYPE = eqtype
         self.HistorySettings = rate_settings
         self.HistoryRate = rate
+        self.Priority = 0
         self.DataList = []
+        # Size of every LVDATA in DataList, if fixed by a VariableHandle
+        self.RecordSize = None
+        # MemoryBudget accounting for DataList (None: not accounted)
+        self.Budget = None
+        self.MaxBytes = None
+        self.EvictionPolicy = None
+        self.Evicted = 0
+        # Samples added over the limit with EVICT_DECIMATE
+        self.Decimated = 0
+        # LatencyTracer, and the time each LVDATA in DataList was added
+        self.Tracer = None
+        self.EnqueueTimes = None
+        self.HeaderPrefix = self.LVBANKPREFIX.pack(self.BANK,
+                                                   self.DATATYPE,
+                                                   self.VARCATEGORY,
+                                                   self.VARNAME,
+                                                   self.EQTYPE,
+                                                   self.HistorySettings,
+                                                   self.HistoryRate,
+                                                   DataByteOrder,  # Timestamp
+                                                   DataByteOrder)  # Data
 
     def IsBankMatch(self, category, varname):
         if self.VARCATEGORY == category:
@@ -642,12 +2456,68 @@ class DataBank:
         # Pack timestamp and data array into LVDATA format
         lvdata = struct.pack(self.LVDATA.format(len(data)), timestamp, data)
         # Check the length of the last array matches the first
-        self.r.acquire()
-        if len(self.DataList) > 0:
+        if self.RecordSize is not None:
+            assert self.RecordSize == len(lvdata)
+        elif len(self.DataList) > 0:
             assert len(self.DataList[0]) == len(lvdata)
+        self.AddRecord(lvdata)
+
+    # Add an LVDATA that is already packed (and the right size)
+    def AddRecord(self, lvdata):
+        if self.Budget is not None and \
+                not self.Budget.Admit(self, len(lvdata)):
+            return
         # Add this LVDATA to a list for later flattening (thread safe)
+        self.r.acquire()
         self.DataList.append(lvdata)
+        if self.EnqueueTimes is not None:
+            self.EnqueueTimes.append(time.monotonic())
+        self.r.release()
+
+    # Record when each LVDATA is added for tracer (None to stop). Data
+    # already waiting counts as added now
+    def StartTracing(self, tracer):
+        self.r.acquire()
+        self.Tracer = tracer
+        self.EnqueueTimes = None
+        if tracer is not None:
+            self.EnqueueTimes = [time.monotonic()] * len(self.DataList)
+        self.r.release()
+
+    # Throw away everything waiting in DataList, returns number of arrays
+    def Drop(self):
+        self.r.acquire()
+        size = self.BytesHeld()
+        n = len(self.DataList)
+        self.DataList = []
+        if self.EnqueueTimes is not None:
+            self.EnqueueTimes = []
         self.r.release()
+        if self.Budget is not None:
+            self.Budget.Release(size)
+        return n
+
+    # Bytes of LVDATA waiting in DataList (they are all the same size)
+    def BytesHeld(self):
+        DataList = self.DataList
+        if len(DataList) == 0:
+            return 0
+        return len(DataList) * len(DataList[0])
+
+    # Evict the oldest LVDATA to free at least size bytes (for the
+    # MemoryBudget), returns the bytes freed
+    def Evict(self, size):
+        self.r.acquire()
+        n = 0
+        if len(self.DataList):
+            record_size = len(self.DataList[0])
+            n = min(len(self.DataList), -(-size // record_size))
+            del self.DataList[0:n]
+            if self.EnqueueTimes is not None:
+                del self.EnqueueTimes[0:n]
+            self.Evicted += n
+        self.r.release()
+        return n * record_size if n else 0
 
     # Number of items in DataList (Count of arrays logged to bank)
     def NumberToFlush(self):
@@ -670,63 +2540,61 @@ class DataBank:
             return
         # print("Banks to flush:" + str(self.NumberToFlush() ) +
         #       " Data length:" + str(self.DataLengthOfAllBank()))
-        lump = b''
         LocalList = self.DataList
         self.DataList = []
+        [tracer, LocalTimes] = [self.Tracer, self.EnqueueTimes]
+        if LocalTimes is not None:
+            self.EnqueueTimes = []
         self.r.release()
         # Remove space needed for header
         buffer_remaining -= 88
         block_size = len(LocalList[0])
         num_blocks = 0
-        # Unfold data in DataList list, stop if we run out of buffer
-        while buffer_remaining > block_size and len(LocalList):
-            lump = struct.pack('{}s{}s'.format(len(lump),
-                                               block_size),
-                               lump,
-                               LocalList.pop(0))
-            buffer_remaining -= block_size
-            if len(lump):
-                num_blocks += 1
-        # If we didn't unfold everything, then put it back in the DataList
-        if len(LocalList) > 0:
+        try:
+            # Unfold data in DataList list, stop if we run out of buffer
+            if buffer_remaining > block_size:
+                num_blocks = min(len(LocalList),
+                                 (buffer_remaining - 1) // block_size)
+            lump = b''.join(LocalList[0:num_blocks])
+            del LocalList[0:num_blocks]
+            if self.Budget is not None:
+                self.Budget.Release(num_blocks * block_size)
+            if LocalTimes is not None:
+                tracer.Packed(LocalTimes[0:num_blocks])
+                del LocalTimes[0:num_blocks]
+        finally:
+            # If we didn't unfold everything, then put it back in the
+            # DataList (before anything else can go wrong)
+            overflow = len(LocalList) > 0
+            if overflow:
+                self.r.acquire()
+                if self.EnqueueTimes is not None:
+                    # Tracing may have started while this was flushing
+                    if LocalTimes is None:
+                        LocalTimes = [time.monotonic()] * len(LocalList)
+                    LocalTimes.extend(self.EnqueueTimes)
+                    self.EnqueueTimes = LocalTimes
+                LocalList.extend(self.DataList)
+                self.DataList = LocalList
+                self.r.release()
+        if overflow:
             print("Overflow prevented (" +
                   str(caller.BufferOverflowCount) +
                   ")")
             # caller.AnnounceOnSpeaker("THISHOST",
             #                          "Event Buffer Overflow prevented")
             caller.BufferOverflowCount += 1
-            if caller.BufferOverflowCount > 100:
-                caller.AnnounceOnSpeaker("THISHOST",
-                                         "DataPacker on " +
-                                         caller.MyHostName +
-                                         " limited by data rate for \
-                                         more than a minute")
-                caller.BufferOverflowCount = 0
-            self.r.acquire()
-            while len(LocalList) > 0:
-                self.DataList.append(LocalList.pop(0))
-            self.r.release()
+            # (the DataPacker announces when this passes 100)
+            caller.OverflowBanks.append(self)
 
         # Dimensions of LVDATA in BANK
         if num_blocks == 0:
             return b''
         # self.print()
-        # All items in DataList used, clear the memory
-        LocalList.clear()
         # Build entire bank with header
-        BANK = struct.pack(self.LVBANK.format(len(lump)),
-                           self.BANK,
-                           self.DATATYPE,
-                           self.VARCATEGORY,
-                           self.VARNAME,
-                           self.EQTYPE,
-                           self.HistorySettings,
-                           self.HistoryRate,
-                           DataByteOrder,  # Timestamp byte order
-                           DataByteOrder,  # Data byte order
-                           block_size,
-                           num_blocks,
-                           lump)
+        BANK = b''.join([self.HeaderPrefix,
+                         self.LVBANKBLOCKS.pack(block_size, num_blocks),
+                         lump])
         return BANK
 
 
@@ -0,0 +1,47 @@
+# Measure how long it takes to import MIDAS_GEM, build a DataPacker and get
+# the first data flushed to MIDAS
+# Usage: python3 bench_startup.py [midas_server] [port]
+import subprocess
+import sys
+import time
+
+# Import time is measured in a fresh interpreter each time
+ImportTimes = []
+for i in range(11):
+    out = subprocess.check_output([sys.executable,
+                                   "-c",
+                                   "import time; " +
+                                   "t = time.perf_counter(); " +
+                                   "import MIDAS_GEM; " +
+                                   "print(time.perf_counter() - t)"])
+    ImportTimes.append(float(out.split()[-1]))
+ImportTimes.sort()
+print("Import time (median of 11): " +
+      str(1000. * ImportTimes[5]) + " ms")
+
+from MIDAS_GEM import *
+
+server = "alphamidastest8"
+port = 12345
+if len(sys.argv) > 1:
+    server = sys.argv[1]
+if len(sys.argv) > 2:
+    port = int(sys.argv[2])
+
+start = time.time()
+packer = DataPacker(server, port)
+print("DataPacker() time: " + str(1000. * (time.time() - start)) + " ms")
+
+packer.AddData("CategoryName",
+               "VariableName",
+               "Startup benchmark",
+               0,
+               1,
+               GetLVTimeNow(),
+               array.array('d', [0.1, 0.2, 0.3]))
+packer.start()
+while packer.TimeToFirstFlush is None:
+    time.sleep(0.001)
+print("Time to first flush: " +
+      str(1000. * packer.TimeToFirstFlush) + " ms")
+packer.stop()
@@ -2,6 +2,7 @@ from MIDAS_GEM import *
 
 # Global data packer, one create one of these
 packer=DataPacker("alphamidastest8")
+packer.start()
 
 # You can get the RunNumber and RunStatus at any time.
 # The first time these are called there is a small delay,
@@ -9,6 +10,13 @@ packer=DataPacker("alphamidastest8")
 print("Current Run Number: "+str(packer.GetRunNumber()))
 print("Current Run Status: "+str(packer.GetRunStatus()))
 
+# Variables logged often can be bound once, which makes logging them cheaper
+fast_variable=packer.variable("CategoryName",
+                             "FastVariable",
+                             "32 Character Description",
+                             'd',
+                             10)
+
 while True:
     #Do some work...
     time.sleep(1)
@@ -21,5 +29,6 @@ while True:
                    GetLVTimeNow(),
                    array.array('d',[0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9,1.0])
                    )
+    fast_variable.log(array.array('d',[0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9,1.0]))
     print("Current Run Number: "+str(packer.GetRunNumber()))
     #python arrays are prefered, numpy arrays are supported as well as lists of doubles
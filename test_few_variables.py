@@ -1,8 +1,11 @@
 #!python3
 from MIDAS_GEM import *
+if HaveNumpy:
+    import numpy as np
 
 #Global data packer
 packer=DataPacker(midas_server="thevoid",port=12345,max_data_rate=100000)
+packer.start()
 
 #packer.TurnOnTestMode()
 #packer.TurnOnDebugMode()
@@ -1,7 +1,10 @@
 from MIDAS_GEM import *
+if HaveNumpy:
+    import numpy as np
 
 #Global data packer
 packer=DataPacker(midas_server="alphamidastest8",port=5555,max_data_rate=10000000) #10M
+packer.start()
 
 
 
@@ -0,0 +1,351 @@
+# Behaviour tests of MIDAS_GEM that need no network: the DataPacker talks
+# to a fake frontend on a local socket
+# Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+import array
+import collections
+import gc
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from MIDAS_GEM import *
+
+
+# Just enough of the feGEM frontend for the DataPacker: it negotiates the
+# connection, counts the samples of each variable and replies to every
+# event (with "ERROR..." if it has a variable in reject)
+class FakeFrontend:
+    def __init__(self, event_size=100000, delay=0., reject=()):
+        self.EventSize = event_size
+        self.Delay = delay
+        self.Reject = set(reject)
+        self.Samples = collections.Counter()
+        self.Lock = threading.Lock()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(50)
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.__Accept, daemon=True).start()
+
+    def close(self):
+        self.server.close()
+
+    def __Accept(self):
+        while True:
+            try:
+                connection = self.server.accept()[0]
+            except OSError:
+                return
+            threading.Thread(target=self.__Handle,
+                             args=(connection,),
+                             daemon=True).start()
+
+    def __Read(self, connection, n):
+        data = b''
+        while len(data) < n:
+            chunk = connection.recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def __Banks(self, connection, magic):
+        if magic == b"GEA1":
+            [BankArrayID, length, number_of_banks] = \
+                struct.unpack('III', self.__Read(connection, 12))
+            lump = self.__Read(connection, length)
+        else:
+            BankArrayID = None
+            header = magic + self.__Read(connection, 84)
+            [block_size, num_blocks] = struct.unpack_from('ii', header, 80)
+            lump = header + self.__Read(connection, block_size * num_blocks)
+        banks = []
+        while len(lump):
+            header = struct.unpack_from('4s4s16s16s32shhhhii', lump)
+            banks.append(header)
+            lump = lump[88 + header[9] * header[10]:]
+        return [BankArrayID, banks]
+
+    def __Handle(self, connection):
+        while True:
+            try:
+                magic = self.__Read(connection, 4)
+            except OSError:
+                magic = None
+            if magic is None:
+                connection.close()
+                return
+            [BankArrayID, banks] = self.__Banks(connection, magic)
+            reply = {"msg": "ok {braces} in strings"}
+            rejected = False
+            for header in banks:
+                varname = header[3].rstrip(b"\0").decode()
+                if varname in self.Reject:
+                    rejected = True
+                if varname != "COMMAND":
+                    self.Lock.acquire()
+                    self.Samples[varname] += header[10]
+                    self.Lock.release()
+                    continue
+                command = header[4].rstrip(b"\0")
+                if command == b"START_FRONTEND":
+                    reply["FrontendStatus"] = "Running"
+                elif command == b"GIVE_ME_ADDRESS":
+                    reply["SendToAddress"] = "127.0.0.1"
+                elif command == b"GIVE_ME_PORT":
+                    reply["SendToPort"] = self.port
+                elif command in (b"GET_EVENT_SIZE", b"SET_EVENT_SIZE"):
+                    reply["EventSize"] = self.EventSize
+                elif command == b"GET_RUNNO":
+                    reply["RunNumber"] = 42
+                elif command == b"GET_STATUS":
+                    reply["RunStatus"] = "Running"
+            if BankArrayID is not None:
+                reply["BankArrayID"] = BankArrayID
+            time.sleep(self.Delay)
+            try:
+                if rejected:
+                    # No newline, the client closes the connection
+                    connection.sendall(b"ERROR rejected bank")
+                else:
+                    connection.sendall(json.dumps(reply).encode())
+            except OSError:
+                return
+
+
+def Values(bank):
+    return [struct.unpack('d', lvdata[16:])[0] for lvdata in bank.DataList]
+
+
+def Log(packer, varname, values, category="TEST"):
+    for value in values:
+        packer.AddData(category, varname, "", 0, 1, GetLVTimeNow(),
+                       array.array('d', [value]))
+
+
+def WaitFor(condition, timeout=10.):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class ReplyReaderTest(unittest.TestCase):
+    def test_reply_split_across_chunks(self):
+        reader = ReplyReader(None)
+        for chunk in [b'{"msg": "a}{', b'b\\" }", "n": {"x"', b': 1}}']:
+            reader.Feed(chunk)
+        self.assertEqual(list(reader.Replies),
+                         [{"msg": 'a}{b" }', "n": {"x": 1}}])
+
+    def test_several_replies_in_one_chunk(self):
+        reader = ReplyReader(None)
+        reader.Feed(b'{"a": 1} {"b": 2}\nERROR bad bank\n{"c": 3}')
+        self.assertEqual(list(reader.Replies),
+                         [{"a": 1}, {"b": 2}, b"ERROR bad bank", {"c": 3}])
+
+    def test_single_reply_error_without_newline(self):
+        [a, b] = socket.socketpair()
+        a.settimeout(2.)
+        b.sendall(b"ERROR bad bank")
+        reply = ReplyReader(a, single_reply=True).Read()
+        self.assertEqual(reply, b"ERROR bad bank")
+        a.close()
+        b.close()
+
+    def test_connection_closed_mid_reply(self):
+        [a, b] = socket.socketpair()
+        a.settimeout(2.)
+        b.sendall(b'{"a": ')
+        b.close()
+        with self.assertRaises(ConnectionResetError):
+            ReplyReader(a).Read()
+        a.close()
+
+
+class DataPackerTest(unittest.TestCase):
+    def setUp(self):
+        ConfigureMemoryBudget()
+
+    def test_close_sends_everything(self):
+        frontend = FakeFrontend()
+        packer = DataPacker("127.0.0.1", frontend.port).start()
+        Log(packer, "Var", range(200))
+        self.assertTrue(packer.close())
+        self.assertEqual(frontend.Samples["Var"], 200)
+        frontend.close()
+
+    def test_close_waits_for_backlog_space(self):
+        frontend = FakeFrontend(event_size=2000, delay=0.002)
+        packer = DataPacker("127.0.0.1", frontend.port).start()
+        packer.Endpoints[0].MaxBacklog = 5
+        Log(packer, "Var", range(2000))
+        self.assertTrue(packer.close(30.))
+        self.assertEqual(packer.Endpoints[0].DroppedEvents, 0)
+        self.assertEqual(frontend.Samples["Var"], 2000)
+        frontend.close()
+
+    def test_close_before_start(self):
+        ConfigureMemoryBudget(max_bytes=10000)
+        packer = DataPacker("127.0.0.1", 1)
+        Log(packer, "Var", range(10))
+        self.assertFalse(packer.close())
+        self.assertEqual(GetMemoryBudget().Held, 0)
+        with self.assertRaises(RuntimeError):
+            Log(packer, "Var", [1.])
+
+    def test_run_number_needs_start(self):
+        packer = DataPacker("127.0.0.1", 1)
+        with self.assertRaises(RuntimeError):
+            packer.GetRunNumber()
+        with self.assertRaises(RuntimeError):
+            packer.GetRunStatus()
+
+    def test_run_number(self):
+        frontend = FakeFrontend()
+        packer = DataPacker("127.0.0.1", frontend.port).start()
+        self.assertEqual(packer.GetRunNumber(), 42)
+        self.assertEqual(packer.GetRunStatus(), "Running")
+        packer.close()
+        frontend.close()
+
+    def test_handle_after_restart(self):
+        frontend = FakeFrontend()
+        packer = DataPacker("127.0.0.1", frontend.port).start()
+        handle = packer.variable("TEST", "Var", "", 'd', 1)
+        handle.log(array.array('d', [0.]))
+        # stop() does not send what is still in the banks
+        self.assertTrue(WaitFor(lambda: frontend.Samples["Var"] == 1))
+        packer.stop()
+        packer.start()
+        for value in range(3):
+            handle.log(array.array('d', [value]))
+        self.assertTrue(packer.close())
+        self.assertEqual(frontend.Samples["Var"], 4)
+        frontend.close()
+
+    def test_handle_checks_type_and_size(self):
+        packer = DataPacker("127.0.0.1", 1)
+        Log(packer, "Var", [1.])
+        with self.assertRaises(ValueError):
+            packer.variable("TEST", "Var", "", 'd', 10)
+        handle = packer.variable("TEST", "Var", "", 'd', 1)
+        with self.assertRaises(TypeError):
+            handle.log(array.array('l', [1]))
+
+    def test_rejected_event_is_not_sent_again(self):
+        frontend = FakeFrontend(reject=["BAD"])
+        packer = DataPacker("127.0.0.1", frontend.port).start()
+        Log(packer, "BAD", [1.])
+        self.assertTrue(WaitFor(
+            lambda: packer.Shedder.ShedCount["reject"] == 1))
+        Log(packer, "GOOD", [1.])
+        self.assertTrue(packer.close())
+        self.assertEqual(packer.Shedder.ShedCount["reject"], 1)
+        self.assertEqual(frontend.Samples["GOOD"], 1)
+        frontend.close()
+
+
+class LoadSheddingTest(unittest.TestCase):
+    def test_raise_keeps_the_sample(self):
+        packer = DataPacker("127.0.0.1", 1, shed_policy=SHED_RAISE)
+        Log(packer, "Var", [1.])
+        packer.Shedder.Pending = DataPackerOverload(200, 100, "Test")
+        with self.assertRaises(DataPackerOverload):
+            Log(packer, "Var", [2.])
+        self.assertEqual(Values(packer.DataBanks[0]), [1., 2.])
+        # Raised once only
+        Log(packer, "Var", [3.])
+
+    def test_check_data_length(self):
+        packer = DataPacker("127.0.0.1", 1)
+        packer.MaxEventSize = 100
+        self.assertTrue(packer.CheckDataLength(100))
+        self.assertFalse(packer.CheckDataLength(101))
+        packer.SetLoadSheddingPolicy(SHED_RAISE)
+        with self.assertRaises(DataPackerOverload):
+            packer.CheckDataLength(101)
+
+    def test_split_bundle_keeps_every_block(self):
+        bank = DataBank(b"DBL\0", b"TEST", b"Var", b"", 0, 1)
+        for value in range(100):
+            bank.AddData(GetLVTimeNow(),
+                         array.array('d', [value]).tobytes())
+        bundle = bank.Flush(DataPacker("127.0.0.1", 1), 100000)
+        events = SplitBundle(bundle, 500)
+        blocks = 0
+        for event in events:
+            self.assertLessEqual(len(event), 500)
+            blocks += struct.unpack_from('i', event, 84)[0]
+        self.assertEqual(blocks, 100)
+
+
+class EvictionTest(unittest.TestCase):
+    def setUp(self):
+        ConfigureMemoryBudget()
+
+    def tearDown(self):
+        ConfigureMemoryBudget()
+
+    # Each sample of one double is 24 bytes in the bank
+    def test_bank_cap_policies(self):
+        packer = DataPacker("127.0.0.1", 1)
+        expected = {
+            EVICT_DROP_OLDEST: [float(value) for value in range(15, 25)],
+            EVICT_DROP_NEWEST: [float(value) for value in range(10)],
+        }
+        for policy, values in expected.items():
+            packer.SetBankCap("TEST", policy, 10 * 24, policy)
+            Log(packer, policy, range(25))
+            bank = packer.DataBanks[-1]
+            self.assertEqual(Values(bank), values)
+            self.assertEqual(packer.EvictionCounts()[(b"TEST",
+                                                      policy.encode())], 15)
+
+    def test_decimate_stride(self):
+        packer = DataPacker("127.0.0.1", 1)
+        packer.SetBankCap("TEST", "Var", 20 * 24, EVICT_DECIMATE)
+        Log(packer, "Var", range(100))
+        self.assertEqual(Values(packer.DataBanks[0]),
+                         [float(value) for value in range(61, 100, 2)])
+
+    def test_global_limit_evicts_largest_bank(self):
+        ConfigureMemoryBudget(max_bytes=10000)
+        packer = DataPacker("127.0.0.1", 1)
+        Log(packer, "FAST", range(1000))
+        Log(packer, "SLOW", range(5))
+        [fast, slow] = packer.DataBanks
+        self.assertEqual(len(slow.DataList), 5)
+        self.assertLessEqual(fast.BytesHeld() + slow.BytesHeld(), 10000)
+
+    def test_dead_packer_releases_budget(self):
+        ConfigureMemoryBudget(max_bytes=1000)
+        packer = DataPacker("127.0.0.1", 1)
+        Log(packer, "Var", range(40))
+        del packer
+        gc.collect()
+        packer = DataPacker("127.0.0.1", 1)
+        Log(packer, "Var", range(20))
+        self.assertEqual(packer.EvictionCounts(), {})
+
+    def test_block_times_out(self):
+        ConfigureMemoryBudget(max_bytes=48, policy=EVICT_BLOCK,
+                              block_timeout=0.2)
+        packer = DataPacker("127.0.0.1", 1)
+        Log(packer, "Var", range(2))
+        start = time.time()
+        Log(packer, "Var", [2.])
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(Values(packer.DataBanks[0]), [0., 1.])
+        self.assertEqual(packer.EvictionCounts(), {(b"TEST", b"Var"): 1})
+
+
+if __name__ == "__main__":
+    unittest.main()